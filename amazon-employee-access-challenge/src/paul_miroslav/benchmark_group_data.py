@@ -0,0 +1,52 @@
+"""
+Benchmark group_data_vectorized against group_data on the Amazon data, or on
+random data with similar cardinalities if the csv files are not found.
+
+Usage: python benchmark_group_data.py [n_jobs]
+"""
+from __future__ import print_function
+import os
+import sys
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from logistic_regression_updated import group_data, group_data_vectorized
+
+def load_data(train='../../data/train.csv', test='../../data/test.csv'):
+    if os.path.exists(train) and os.path.exists(test):
+        train_data = pd.read_csv(train)
+        test_data = pd.read_csv(test)
+        return np.vstack((train_data.ix[:,1:-1], test_data.ix[:,1:-1]))
+    rng = np.random.RandomState(0)
+    cardinalities = [7500, 4200, 130, 180, 450, 340, 2350, 70, 340]
+    return np.column_stack([rng.zipf(1.5, 91690) % c for c in cardinalities])
+
+def same_groups(a, b):
+    """True if the columns of a and b partition the rows in the same way"""
+    for col_a, col_b in zip(a.T, b.T):
+        n_a = len(np.unique(col_a))
+        n_b = len(np.unique(col_b))
+        n_ab = len(set(zip(col_a, col_b)))
+        if not n_a == n_b == n_ab:
+            return False
+    return True
+
+if __name__ == '__main__':
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    data = load_data()
+    print("%d rows, %d columns" % data.shape)
+    for degree in (2, 3):
+        t0 = time()
+        reference = group_data(data, degree=degree)
+        reference_time = time() - t0
+        print("degree %d, group_data: %.2fs" % (degree, reference_time))
+        for jobs in (1, n_jobs):
+            t0 = time()
+            grouped = group_data_vectorized(data, degree=degree, n_jobs=jobs)
+            duration = time() - t0
+            print("degree %d, group_data_vectorized(n_jobs=%d): %.2fs, "
+                  "speedup %.1fx, same groups: %s"
+                  % (degree, jobs, duration, reference_time / duration,
+                     same_groups(reference, grouped)))
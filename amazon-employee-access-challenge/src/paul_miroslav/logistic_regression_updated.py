@@ -4,8 +4,10 @@ __date__ = '14-06-2013'
 
 from numpy import array, hstack
 from sklearn import metrics, cross_validation, linear_model
+from sklearn.base import clone
 from scipy import sparse
 from itertools import combinations
+from multiprocessing import Pool, cpu_count
 
 import numpy as np
 import pandas as pd
@@ -24,32 +26,90 @@ def group_data(data, degree=3, hash=hash):
         new_data.append([hash(tuple(v)) for v in data[:,indicies]])
     return array(new_data).T
 
+def combine_columns(codes):
+    """
+    numpy.array -> numpy.array
+    
+    Maps each distinct row of a matrix of integer codes to an integer label
+    """
+    labels = np.zeros(codes.shape[0], dtype=np.int64)
+    bound = 1
+    for col in codes.T:
+        radix = int(col.max()) + 1
+        if bound * radix >= 2 ** 62:
+            # Relabel before the mixed radix number overflows
+            labels = np.unique(labels, return_inverse=True)[1]
+            bound = int(labels.max()) + 1
+        labels = labels * radix + col
+        bound *= radix
+    return np.unique(labels, return_inverse=True)[1]
+
+# Integer codes of the columns, sent once to each worker process
+_codes = None
+
+def _init_worker(codes):
+    global _codes
+    _codes = codes
+
+def _combine_worker(indicies):
+    return combine_columns(_codes[:,indicies])
+
+def group_data_vectorized(data, degree=3, n_jobs=1):
+    """ 
+    numpy.array -> numpy.array
+    
+    Same grouping as group_data, computed with numpy: the columns are coded
+    as integers once and the codes of each combination are combined
+    arithmetically. The labels differ from the hashes of group_data but
+    define the same groups. Combinations are spread over n_jobs processes.
+    """
+    codes = np.column_stack([np.unique(col, return_inverse=True)[1]
+                             for col in data.T])
+    m,n = data.shape
+    all_indicies = [list(indicies) for indicies in combinations(range(n), degree)]
+    if n_jobs == 1:
+        new_data = [combine_columns(codes[:,indicies]) for indicies in all_indicies]
+    else:
+        pool = Pool(n_jobs, _init_worker, (codes,))
+        try:
+            new_data = pool.map(_combine_worker, all_indicies)
+        finally:
+            pool.terminate()
+            pool.join()
+    return array(new_data).T
+
 def OneHotEncoder(data, keymap=None):
      """
      OneHotEncoder takes data matrix with categorical columns and
      converts it to a sparse binary matrix.
      
-     Returns sparse binary matrix and keymap mapping categories to indicies.
-     If a keymap is supplied on input it will be used instead of creating one
-     and any categories appearing in the data that are not in the keymap are
+     Returns sparse binary matrix and keymap mapping categories to indicies:
+     the sorted array of the categories of each column. If a keymap is
+     supplied on input it will be used instead of creating one and any
+     categories appearing in the data that are not in the keymap are
      ignored
      """
      if keymap is None:
-          keymap = []
-          for col in data.T:
-               uniques = set(list(col))
-               keymap.append(dict((key, i) for i, key in enumerate(uniques)))
+          keymap = [np.unique(col) for col in data.T]
      total_pts = data.shape[0]
-     outdat = []
+     offset = 0
+     outcols = []
      for i, col in enumerate(data.T):
-          km = keymap[i]
-          num_labels = len(km)
-          spmat = sparse.lil_matrix((total_pts, num_labels))
-          for j, val in enumerate(col):
-               if val in km:
-                    spmat[j, km[val]] = 1
-          outdat.append(spmat)
-     outdat = sparse.hstack(outdat).tocsr()
+          keys = keymap[i]
+          # Index of each value among the sorted categories, -1 if unknown
+          pos = np.searchsorted(keys, col)
+          pos[pos == len(keys)] = 0
+          known = len(keys) > 0 and keys[pos] == col
+          outcols.append(np.where(known, pos + offset, -1))
+          offset += len(keys)
+     # Build the CSR arrays directly: the column indices of each row are
+     # increasing as the offsets are
+     outcols = np.column_stack(outcols)
+     known = outcols >= 0
+     indptr = np.concatenate(([0], np.cumsum(known.sum(axis=1))))
+     indices = outcols[known]
+     outdat = sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                                shape=(total_pts, offset))
      return outdat, keymap
 
 def create_test_submission(filename, prediction):
@@ -74,8 +134,179 @@ def cv_loop(X, y, model, N):
         print "AUC (fold %d/%d): %f" % (i + 1, N, auc)
         mean_auc += auc
     return mean_auc/N
+
+def cv_folds(num_rows, N):
+    """
+    Row indices of the (train, cv) splits of cv_loop, computed once
+    """
+    indices = np.arange(num_rows)
+    return [cross_validation.train_test_split(indices, test_size=.20,
+                                              random_state = i*SEED)
+            for i in range(N)]
+
+def split_folds(X, folds):
+    """
+    Splits the rows of X into a list of (train, cv) pairs, one per fold
+    """
+    return [(X[train], X[cv]) for train, cv in folds]
+
+def append_folds(X_folds, Y_folds):
+    """
+    Appends the columns of each fold of Y_folds to the same fold of X_folds
+    """
+    return [(sparse.hstack((X_train, Y_train)).tocsr(),
+             sparse.hstack((X_cv, Y_cv)).tocsr())
+            for (X_train, X_cv), (Y_train, Y_cv) in zip(X_folds, Y_folds)]
+
+def stack_folds(folds_list):
+    """
+    Stacks the columns of several lists of folds, fold by fold
+    """
+    return [(sparse.hstack([X_train for X_train, X_cv in fold]).tocsr(),
+             sparse.hstack([X_cv for X_train, X_cv in fold]).tocsr())
+            for fold in zip(*folds_list)]
+
+def cv_loop_folds(X_folds, y_folds, model):
+    """
+    Same as cv_loop on data already split by split_folds
+    """
+    mean_auc = 0.
+    N = len(X_folds)
+    for i, ((X_train, X_cv), (y_train, y_cv)) in enumerate(zip(X_folds, y_folds)):
+        model.fit(X_train, y_train)
+        preds = model.predict_proba(X_cv)[:,1]
+        auc = metrics.auc_score(y_cv, preds)
+        print "AUC (fold %d/%d): %f" % (i + 1, N, auc)
+        mean_auc += auc
+    return mean_auc/N
+
+# Data of the feature selection, set in each worker process
+_shared = {}
+
+def _init_selection_worker(Xts_folds, y_folds, model):
+    _shared.update(Xts_folds=Xts_folds, y_folds=y_folds, model=model,
+                   selected=None, selected_folds={})
+
+def _candidate_fold_auc(task):
+    f, k, selected = task
+    Xts_folds = _shared['Xts_folds']
+    if selected != _shared['selected']:
+        # A new greedy step: the folds of the previous selection are stale
+        _shared.update(selected=selected, selected_folds={})
+    X_folds = [Xts_folds[f][k]]
+    if selected:
+        # Stacked once per fold and step in each worker
+        if k not in _shared['selected_folds']:
+            _shared['selected_folds'][k], = stack_folds(
+                [[Xts_folds[g][k]] for g in selected])
+        X_folds = append_folds([_shared['selected_folds'][k]], X_folds)
+    (X_train, X_cv), = X_folds
+    y_train, y_cv = _shared['y_folds'][k]
+    model = _shared['model']
+    model.fit(X_train, y_train)
+    preds = model.predict_proba(X_cv)[:,1]
+    return metrics.auc_score(y_cv, preds)
+
+def selection_pool(Xts_folds, y_folds, model, n_jobs):
+    """
+    Pool of n_jobs processes for score_candidates, to be created once per
+    feature selection run and terminated by the caller
+    """
+    # With fork the workers share the arrays of the parent process
+    return Pool(n_jobs, _init_selection_worker, (Xts_folds, y_folds, model))
+
+def score_candidates(candidates, Xts_folds, selected, y_folds, model,
+                     pool=None):
+    """
+    Mean AUC over the folds of the selected features plus each candidate
+    
+    Xts_folds holds the one hot encoding of each feature already split by
+    split_folds, so the candidates are not split again at each step.
+    selected lists the features selected so far, in order.
+    
+    The candidate x fold fits are spread over the processes of pool, see
+    selection_pool. The AUCs are averaged in the same order as cv_loop_folds
+    so the scores are equal to the ones of a serial run.
+    """
+    if pool is None:
+        selected_folds = None
+        if selected:
+            selected_folds = stack_folds([Xts_folds[g] for g in selected])
+        scores = []
+        for f in candidates:
+            X_folds = Xts_folds[f]
+            if selected_folds is not None:
+                X_folds = append_folds(selected_folds, X_folds)
+            scores.append(cv_loop_folds(X_folds, y_folds, model))
+        return scores
+    
+    N = len(y_folds)
+    selected = tuple(selected)
+    aucs = pool.map(_candidate_fold_auc,
+                    [(f, k, selected) for f in candidates for k in range(N)])
+    scores = []
+    for i in range(len(candidates)):
+        mean_auc = 0.
+        for auc in aucs[i*N:(i+1)*N]:
+            mean_auc += auc
+        scores.append(mean_auc/N)
+    return scores
+
+def _init_path_worker(X_folds, y_folds, model, Cvals):
+    _shared.update(X_folds=X_folds, y_folds=y_folds, model=model,
+                   Cvals=Cvals)
+
+def _fold_c_path(k):
+    X_train, X_cv = _shared['X_folds'][k]
+    y_train, y_cv = _shared['y_folds'][k]
+    return c_path_aucs(X_train, X_cv, y_train, y_cv, _shared['model'],
+                       _shared['Cvals'])
+
+def c_path_aucs(X_train, X_cv, y_train, y_cv, model, Cvals):
+    """
+    AUC on the cv set for each value of C in Cvals, fitted from scratch as
+    in cv_loop
+    """
+    model = clone(model)
+    aucs = []
+    for C in Cvals:
+        model.set_params(C=C)
+        model.fit(X_train, y_train)
+        preds = model.predict_proba(X_cv)[:,1]
+        aucs.append(metrics.auc_score(y_cv, preds))
+    return aucs
+
+def cv_c_path(X_folds, y_folds, model, Cvals, n_jobs=1):
+    """
+    Mean AUC over the folds for each value of C in Cvals
     
-def main(train='../../data/train.csv', test='../../data/test.csv', submit='miroslav_pred.csv'):    
+    The folds are spread over n_jobs processes, each one sweeping all the
+    values of C on its fold with c_path_aucs.
+    """
+    N = len(X_folds)
+    if n_jobs == 1:
+        fold_aucs = [c_path_aucs(X_train, X_cv, y_train, y_cv, model, Cvals)
+                     for (X_train, X_cv), (y_train, y_cv)
+                     in zip(X_folds, y_folds)]
+    else:
+        pool = Pool(n_jobs, _init_path_worker,
+                    (X_folds, y_folds, model, Cvals))
+        try:
+            fold_aucs = pool.map(_fold_c_path, range(N))
+        finally:
+            pool.terminate()
+            pool.join()
+    # Averaged in fold order as in cv_loop
+    scores = []
+    for i in range(len(Cvals)):
+        mean_auc = 0.
+        for aucs in fold_aucs:
+            mean_auc += aucs[i]
+        scores.append(mean_auc/N)
+    return scores
+    
+def main(train='../../data/train.csv', test='../../data/test.csv', submit='miroslav_pred.csv',
+         n_jobs=1):    
     print "Reading dataset..."
     train_data = pd.read_csv(train)
     test_data = pd.read_csv(test)
@@ -85,8 +316,8 @@ def main(train='../../data/train.csv', test='../../data/test.csv', submit='miros
     
     # Transform data
     print "Transforming data..."
-    dp = group_data(all_data, degree=2) 
-    dt = group_data(all_data, degree=3)
+    dp = group_data_vectorized(all_data, degree=2) 
+    dt = group_data_vectorized(all_data, degree=3)
 
     y = array(train_data.ACTION)
     X = all_data[:num_train]
@@ -111,19 +342,36 @@ def main(train='../../data/train.csv', test='../../data/test.csv', submit='miros
     score_hist = []
     N = 10
     good_features = set([])
-    # Greedy feature selection loop
-    while len(score_hist) < 2 or score_hist[-1][0] > score_hist[-2][0]:
-        scores = []
-        for f in range(len(Xts)):
-            if f not in good_features:
-                feats = list(good_features) + [f]
-                Xt = sparse.hstack([Xts[j] for j in feats]).tocsr()
-                score = cv_loop(Xt, y, model, N)
+    # The folds of cv_loop are computed once and each feature is kept split
+    # by fold: each candidate only appends its own columns to the ones of
+    # the selected features
+    folds = cv_folds(num_train, N)
+    y_folds = split_folds(y, folds)
+    Xts_folds = [split_folds(Xt, folds) for Xt in Xts]
+    selected = []
+    # The worker processes are started once for the whole selection
+    pool = None
+    if n_jobs > 1:
+        pool = selection_pool(Xts_folds, y_folds, model, n_jobs)
+    try:
+        # Greedy feature selection loop
+        while len(score_hist) < 2 or score_hist[-1][0] > score_hist[-2][0]:
+            scores = []
+            candidates = [f for f in range(len(Xts)) if f not in good_features]
+            candidate_scores = score_candidates(candidates, Xts_folds, selected,
+                                                y_folds, model, pool=pool)
+            for f, score in zip(candidates, candidate_scores):
                 scores.append((score, f))
                 print "Feature: %i Mean AUC: %f" % (f, score)
-        good_features.add(sorted(scores)[-1][1])
-        score_hist.append(sorted(scores)[-1])
-        print "Current features: %s" % sorted(list(good_features))
+            best_feature = sorted(scores)[-1][1]
+            good_features.add(best_feature)
+            selected.append(best_feature)
+            score_hist.append(sorted(scores)[-1])
+            print "Current features: %s" % sorted(list(good_features))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
     
     # Remove last added feature from good_features
     good_features.remove(score_hist[-1][1])
@@ -135,11 +383,14 @@ def main(train='../../data/train.csv', test='../../data/test.csv', submit='miros
     score_hist = []
     Xt = sparse.hstack([Xts[j] for j in good_features]).tocsr()
     Cvals = np.logspace(-4, 4, 15, base=2)
-    for C in Cvals:
-        model.C = C
-        score = cv_loop(Xt, y, model, N)
+    C_scores = cv_c_path(split_folds(Xt, folds), y_folds, model, Cvals,
+                         n_jobs=n_jobs)
+    for C, score in zip(Cvals, C_scores):
         score_hist.append((score,C))
         print "C: %f Mean AUC: %f" %(C, score)
+    # The full model is still trained with the last C, as left by the
+    # sequential loop
+    model.C = Cvals[-1]
     bestC = sorted(score_hist)[-1][1]
     print "Best C value: %f" % (bestC)
     
@@ -159,6 +410,7 @@ def main(train='../../data/train.csv', test='../../data/test.csv', submit='miros
 if __name__ == "__main__":
     args = { 'train':  '../../data/train.csv',
              'test':   '../../data/test.csv',
-             'submit': 'miroslav_pred.csv' }
+             'submit': 'miroslav_pred.csv',
+             'n_jobs': cpu_count() }
     main(**args)
     
@@ -0,0 +1,55 @@
+"""Compare the execution backends of RandomizedGridSeach on one grid search
+
+Usage: python benchmark_backends.py [n_jobs]
+
+The IPython backend is included when an IPython cluster is running
+(ipcluster start).
+"""
+from __future__ import print_function
+import sys
+from time import time
+
+from sklearn.datasets import load_digits
+from sklearn.svm import SVC
+
+from model_selection import RandomizedGridSeach
+from model_selection import local_view
+from mmap_utils import persist_cv_splits
+
+
+PARAMETER_GRID = {
+    'C': [0.1, 1, 10, 100],
+    'gamma': [1e-4, 1e-3, 1e-2],
+}
+
+
+def time_search(view, model, cv_split_filenames):
+    search = RandomizedGridSeach(view)
+    t0 = time()
+    search.launch_for_splits(model, PARAMETER_GRID, cv_split_filenames)
+    search.wait()
+    return time() - t0, search.find_bests(n_top=1)[0]
+
+
+if __name__ == "__main__":
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    digits = load_digits()
+    cv_split_filenames = persist_cv_splits(
+        digits.data, digits.target, name='digits_benchmark', n_cv_iter=5,
+        random_state=0)
+
+    views = [(backend, local_view(n_jobs=n_jobs, backend=backend))
+             for backend in ('processes', 'threads', 'loky')]
+    try:
+        try:
+            from IPython.parallel import Client
+        except ImportError:
+            from ipyparallel import Client
+        views.append(('ipython', Client().load_balanced_view()))
+    except Exception as e:
+        print("Skipping the IPython backend: %s" % e)
+
+    for backend, view in views:
+        duration, best = time_search(view, SVC(), cv_split_filenames)
+        print("%-10s %6.2fs  best validation score: %.5f" % (
+            backend, duration, best[0]))
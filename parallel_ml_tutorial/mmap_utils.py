@@ -1,17 +1,43 @@
 import os
-from IPython.parallel import interactive
+try:
+    from IPython.parallel import interactive
+except ImportError:
+    try:
+        # IPython 4+
+        from ipyparallel import interactive
+    except ImportError:
+        def interactive(f):
+            return f
 
 
 @interactive
 def persist_cv_splits(X, y, name=None, n_cv_iter=5, suffix="_cv_%03d.pkl",
                       train_size=None, test_size=0.25, random_state=None,
-                      folder='.'):
-    """Materialize randomized train test splits of a dataset."""
+                      folder='.', indices=False):
+    """Materialize randomized train test splits of a dataset.
+
+    If indices is True, the dataset is stored once in a "_data.pkl" file
+    and each split file only holds the name of that file and the train and
+    test indices: the rows are gathered by the workers.
+
+    Sparse matrices are stored as (format, data, indices, indptr, shape)
+    tuples so that their arrays can be memory mapped by the workers.
+    """
     from sklearn.externals import joblib
     from sklearn.cross_validation import ShuffleSplit
+    from scipy import sparse
     import os
     import uuid
 
+    def pack(a):
+        if not sparse.issparse(a):
+            return a
+        return (a.format + '_matrix', a.data, a.indices, a.indptr, a.shape)
+
+    if sparse.issparse(X) and X.format not in ('csr', 'csc'):
+        # Other formats don't support row indexing
+        X = X.tocsr()
+
     if name is None:
         name = uuid.uuid4().get_hex()
 
@@ -19,8 +45,17 @@ def persist_cv_splits(X, y, name=None, n_cv_iter=5, suffix="_cv_%03d.pkl",
         test_size=test_size, random_state=random_state)
     cv_split_filenames = []
 
+    if indices:
+        # Relative to the split files so that hosts can mount the folder
+        # at different paths
+        data_filename = name + "_data.pkl"
+        joblib.dump((pack(X), y), os.path.join(folder, data_filename))
+
     for i, (train, test) in enumerate(cv):
-        cv_fold = (X[train], y[train], X[test], y[test])
+        if indices:
+            cv_fold = (data_filename, train, test)
+        else:
+            cv_fold = (pack(X[train]), y[train], pack(X[test]), y[test])
         cv_split_filename = os.path.join(folder, name + suffix % i)
         cv_split_filename = os.path.abspath(cv_split_filename)
         joblib.dump(cv_fold, cv_split_filename)
@@ -29,34 +64,111 @@ def persist_cv_splits(X, y, name=None, n_cv_iter=5, suffix="_cv_%03d.pkl",
     return cv_split_filenames
 
 
-def warm_mmap_on_cv_splits(client, cv_split_filenames):
-    """Trigger a disk load on all the arrays of the CV splits
+@interactive
+def load_in_memory(filenames):
+    """Read all the arrays' data in the OS cache, return the duration
 
-    Assume the files are shared on all the hosts using NFS.
+    The pages of memory mapped arrays are first advised with MADV_WILLNEED
+    (or POSIX_FADV_WILLNEED on the file) so that the kernel reads them
+    ahead in large requests, then one item per page is read to wait for
+    the data to be actually loaded.
     """
-    # First step: query cluster to fetch one engine id per host
-    all_engines = client[:]
-
-    @interactive
-    def hostname():
-        import socket
-        return socket.gethostname()
-
-    hostnames = all_engines.apply(hostname).get_dict()
-    one_engine_per_host = dict((hostname, engine_id)
-                               for engine_id, hostname
-                               in hostnames.items())
-    hosts_view = client[one_engine_per_host.values()]
-
-    # Second step: for each data file and host, mmap the arrays of the file
-    # and trigger a sequential read of all the arrays' data
-    @interactive
-    def load_in_memory(filenames):
-        from sklearn.externals import joblib
-        for filename in filenames:
-            arrays = joblib.load(filename, mmap_mode='r')
-            for array in arrays:
-                array.sum()  # trigger the disk read
+    from sklearn.externals import joblib
+    from time import time
+    import mmap
+    import os
+
+    def advise(array):
+        mapping = getattr(array, '_mmap', None)
+        if mapping is not None and hasattr(mapping, 'madvise'):
+            # Python 3.8+
+            mapping.madvise(mmap.MADV_WILLNEED)
+            return
+        filename = getattr(array, 'filename', None)
+        if filename is not None and hasattr(os, 'posix_fadvise'):
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, array.offset, array.nbytes,
+                                 os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def touch(array):
+        flat = array.reshape(-1)
+        flat[::max(1, mmap.PAGESIZE // flat.itemsize)].sum()
+
+    t0 = time()
+    loaded = set()
+    all_arrays = []
+    for filename in filenames:
+        arrays = joblib.load(filename, mmap_mode='r')
+        if isinstance(arrays[0], str):
+            # Index based split: read the shared dataset file only once
+            data_filename = os.path.join(os.path.dirname(filename),
+                                         arrays[0])
+            arrays = arrays[1:]
+            if data_filename not in loaded:
+                loaded.add(data_filename)
+                arrays += joblib.load(data_filename, mmap_mode='r')
+        for array in arrays:
+            if isinstance(array, tuple):
+                # Sparse matrix: read its data, indices and indptr arrays
+                all_arrays.extend(array[1:4])
+            else:
+                all_arrays.append(array)
 
+    # Issue all the read ahead requests before waiting for any of them
+    for array in all_arrays:
+        advise(array)
+    for array in all_arrays:
+        touch(array)
+    return time() - t0
+
+
+@interactive
+def hostname():
+    import socket
+    return socket.gethostname()
+
+
+def engines_per_host(client):
+    """Map the hostnames of the cluster to the ids of their engines"""
+    hostnames = client[:].apply(hostname).get_dict()
+    hosts = {}
+    for engine_id, host in sorted(hostnames.items()):
+        hosts.setdefault(host, []).append(engine_id)
+    return hosts
+
+
+def warm_mmap_on_cv_splits(client, cv_split_filenames, host_filenames=None,
+                           block=True):
+    """Trigger a disk load on all the arrays of the CV splits
+
+    Assume the files are shared on all the hosts using NFS. If client is
+    None, the tasks run on this host and the files are read from this
+    process.
+
+    host_filenames optionally maps hostnames to the subset of the files
+    their engines will use: the other hosts are not warmed. Return a dict
+    mapping hostnames to the warming durations in seconds or, if block is
+    False, to the AsyncResults of the warming tasks.
+    """
     cv_split_filenames = [os.path.abspath(f) for f in cv_split_filenames]
-    hosts_view.apply_sync(load_in_memory, cv_split_filenames)
\ No newline at end of file
+    if client is None:
+        return {hostname(): load_in_memory(cv_split_filenames)}
+
+    # First step: query cluster to fetch the engine ids of each host
+    hosts = engines_per_host(client)
+    if host_filenames is None:
+        host_filenames = dict((host, cv_split_filenames) for host in hosts)
+
+    # Second step: for each host, mmap the arrays of its files and advise
+    # the OS to read them, concurrently on all the hosts
+    results = {}
+    for host, filenames in host_filenames.items():
+        filenames = [os.path.abspath(f) for f in filenames]
+        results[host] = client[hosts[host][0]].apply_async(
+            load_in_memory, filenames)
+    if block:
+        results = dict((host, r.get()) for host, r in results.items())
+    return results
@@ -3,12 +3,27 @@
 Author: Olivier Grisel <olivier@ogrisel.com>
 Licensed: Simplified BSD
 """
+from collections import deque
 from collections import namedtuple
 import os
+import time
 
-from IPython.parallel import interactive
-from IPython.parallel import TaskAborted
-from scipy.stats import sem
+try:
+    from IPython.parallel import interactive
+    from IPython.parallel import TaskAborted
+except ImportError:
+    try:
+        # IPython 4+
+        from ipyparallel import interactive
+        from ipyparallel import TaskAborted
+    except ImportError:
+        # IPython.parallel is only required by the IPython backend, local
+        # backends work without it
+        def interactive(f):
+            return f
+
+        class TaskAborted(Exception):
+            pass
 import numpy as np
 
 from sklearn.utils import check_random_state
@@ -19,6 +34,7 @@ except ImportError:
     # sklearn 0.13
     from sklearn.grid_search import IterGrid as ParameterGrid
 
+from mmap_utils import engines_per_host
 from mmap_utils import warm_mmap_on_cv_splits
 from mmap_utils import persist_cv_splits
 
@@ -27,40 +43,254 @@ def is_aborted(task):
     return isinstance(getattr(task, '_exception', None), TaskAborted)
 
 
+class FutureResult(object):
+    """Wrap a concurrent.futures.Future as an IPython AsyncResult"""
+
+    def __init__(self, future):
+        self.future = future
+
+    def ready(self):
+        return self.future.done()
+
+    def get(self, timeout=None):
+        return self.future.result(timeout=timeout)
+
+    def wait(self, timeout=None):
+        from concurrent.futures import wait
+        wait([self.future], timeout=timeout)
+
+    def abort(self):
+        # Same contract as AsyncResult.abort: running tasks can't be aborted
+        if not self.future.cancel():
+            raise AssertionError("Task is already running or completed")
+        self._exception = TaskAborted()
+
+    def add_done_callback(self, fn):
+        self.future.add_done_callback(lambda future: fn(self))
+
+
+def _apply_by_name(name, args, kwargs):
+    """Call one of the functions of this module by name in a worker"""
+    return globals()[name](*args, **kwargs)
+
+
+class FuturesView(object):
+    """Local stand-in for an IPython load balanced view
+
+    Tasks are submitted to a concurrent.futures executor, for instance a
+    ProcessPoolExecutor, to run the searches on the cores of a single host
+    without an IPython cluster. See `local_view`.
+
+    max_workers is the number of tasks run at once, read from the executor
+    by default.
+    """
+
+    # No IPython client: the CV split files are warmed in this process
+    client = None
+
+    def __init__(self, executor, max_workers=None):
+        self.executor = executor
+        if max_workers is None:
+            max_workers = getattr(executor, '_max_workers', None)
+        self.max_workers = max_workers
+
+    def apply(self, f, *args, **kwargs):
+        if (getattr(f, '__module__', None) == '__main__'
+                and globals().get(f.__name__) is f):
+            # @interactive moves the functions of this module to __main__,
+            # where the worker processes can't unpickle them from
+            return FutureResult(self.executor.submit(
+                _apply_by_name, f.__name__, args, kwargs))
+        return FutureResult(self.executor.submit(f, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def local_view(n_jobs=None, backend='processes'):
+    """Build a FuturesView running tasks on this host
+
+    backend is one of 'processes' (concurrent.futures.ProcessPoolExecutor),
+    'threads' (ThreadPoolExecutor) or 'loky' (the reusable process pool of
+    joblib).
+    """
+    if backend == 'processes':
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+    elif backend == 'threads':
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=n_jobs)
+    elif backend == 'loky':
+        from joblib.externals.loky import get_reusable_executor
+        executor = get_reusable_executor(max_workers=n_jobs)
+    else:
+        raise ValueError("Unknown backend: %r" % backend)
+    return FuturesView(executor)
+
+
 @interactive
 def compute_evaluation(model, cv_split_filename, params=None,
-    train_fraction=1.0, mmap_mode='r'):
-    """Function executed on a worker to evaluate a model on a given CV split"""
+    train_fraction=1.0, mmap_mode='r', cache_filename=None, path=None,
+    warm_start_path=False):
+    """Function executed on a worker to evaluate a model on a given CV split
+
+    If cache_filename is given, the evaluation is also stored in that file
+    as soon as it is computed.
+
+    If path is a (param_name, values) pair, the model is evaluated for each
+    of the values in turn on the loaded split, and the list of the
+    evaluations is returned. cache_filename is then a list of file names,
+    one per value. Each fit starts from scratch unless warm_start_path is
+    True: only valid for parameters such as C of linear models or an
+    increasing n_estimators, where warm_start refits from the previous
+    solution.
+    """
     # All module imports should be executed in the worker namespace
+    import os
     from time import time
+    from scipy import sparse
     from sklearn.externals import joblib
 
-    X_train, y_train, X_test, y_test = joblib.load(
-        cv_split_filename, mmap_mode=mmap_mode)
+    def unpack(a):
+        # Sparse matrices are stored as tuples of memory mapped arrays
+        if not isinstance(a, tuple):
+            return a
+        format, data, indices, indptr, shape = a
+        return getattr(sparse, format)((data, indices, indptr), shape=shape,
+                                       copy=False)
+
+    cv_split = joblib.load(cv_split_filename, mmap_mode=mmap_mode)
+    if len(cv_split) == 3:
+        # Index based split: gather the rows from the shared dataset file,
+        # slicing the training set for learning curves before the copy
+        data_filename, train, test = cv_split
+        X, y = joblib.load(os.path.join(os.path.dirname(cv_split_filename),
+                                        data_filename), mmap_mode=mmap_mode)
+        X = unpack(X)
+        train = train[:int(train_fraction * train.shape[0])]
+        X_train, y_train, X_test, y_test = X[train], y[train], X[test], y[test]
+    else:
+        X_train, y_train, X_test, y_test = map(unpack, cv_split)
+
+        # Slice a subset of the training set for plotting learning curves,
+        # only if needed: slicing sparse matrices copies them
+        n_samples_train = int(train_fraction * X_train.shape[0])
+        if n_samples_train < X_train.shape[0]:
+            X_train = X_train[:n_samples_train]
+            y_train = y_train[:n_samples_train]
+
+    def evaluate(model, params, cache_filename):
+        # Fit model and measure training time
+        t0 = time()
+        model.fit(X_train, y_train)
+        train_time = time() - t0
+
+        # Compute score on training set
+        train_score = model.score(X_train, y_train)
+
+        # Compute score on test set
+        test_score = model.score(X_test, y_test)
 
-    # Slice a subset of the training set for plotting learning curves
-    n_samples_train = int(train_fraction * X_train.shape[0])
-    X_train = X_train[:n_samples_train]
-    y_train = y_train[:n_samples_train]
+        # Wrap evaluation results in a simple tuple datastructure
+        evaluation = (test_score, train_score, train_time,
+                      train_fraction, params)
 
-    # Configure the model
+        if cache_filename is not None:
+            # Write then rename so that a crash never leaves a truncated file
+            tmp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+            joblib.dump(evaluation, tmp_filename)
+            os.rename(tmp_filename, cache_filename)
+
+        return evaluation
+
+    # Configure the model: clone it first as the threads of a local view
+    # share the same instance
     if model is not None:
-        model.set_params(**params)
+        from sklearn.base import clone
+        model = clone(model).set_params(**params)
+
+    if path is None:
+        return evaluate(model, params, cache_filename)
+
+    path_param, path_values = path
+    if cache_filename is None:
+        cache_filename = [None] * len(path_values)
+    if warm_start_path:
+        model.set_params(warm_start=True)
+    evaluations = []
+    for value, filename in zip(path_values, cache_filename):
+        path_model = model if warm_start_path else clone(model)
+        path_model.set_params(**{path_param: value})
+        path_params = dict(params, **{path_param: value})
+        evaluations.append(evaluate(path_model, path_params, filename))
+    return evaluations
+
+
+class CachedResult(object):
+    """Completed task holding an evaluation read from the result cache"""
+
+    def __init__(self, evaluation):
+        self.evaluation = evaluation
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.evaluation
+
+    def wait(self, timeout=None):
+        pass
 
-    # Fit model and measure training time
-    t0 = time()
-    model.fit(X_train, y_train)
-    train_time = time() - t0
+    def abort(self):
+        raise AssertionError("Task is already completed")
+
+
+class PathResult(object):
+    """Evaluation of one of the values of a compute_evaluation path task"""
 
-    # Compute score on training set
-    train_score = model.score(X_train, y_train)
+    def __init__(self, task, index):
+        self.task = task
+        self.index = index
+        if hasattr(task, 'add_done_callback'):
+            self.add_done_callback = lambda fn: task.add_done_callback(
+                lambda _: fn(self))
 
-    # Compute score on test set
-    test_score = model.score(X_test, y_test)
+    @property
+    def _exception(self):
+        return getattr(self.task, '_exception', None)
 
-    # Wrap evaluation results in a simple tuple datastructure
-    return (test_score, train_score, train_time,
-            train_fraction, params)
+    def ready(self):
+        return self.task.ready()
+
+    def get(self, timeout=None):
+        if timeout is None:
+            return self.task.get()[self.index]
+        return self.task.get(timeout)[self.index]
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            return self.task.wait()
+        return self.task.wait(timeout)
+
+    def abort(self):
+        # Aborts the evaluation of the whole path
+        self.task.abort()
+
+
+def file_digest(filename, chunk_size=2 ** 20):
+    """MD5 of the content of a CV split file and of its .npy companions
+
+    (older versions of joblib store the arrays in separate files next to
+    the pickle)
+    """
+    import glob
+    import hashlib
+    md5 = hashlib.md5()
+    for path in sorted(glob.glob(filename + '*')):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
 
 
 # Named tuple to collect evaluation results
@@ -72,15 +302,299 @@ Evaluation = namedtuple('Evaluation', (
     'parameters'))
 
 
+class ResultAggregator(object):
+    """Running statistics of the evaluations of a search
+
+    Each evaluation is fetched once, when its task completes, and folded
+    into running sums per parameter set and per individual parameter
+    value, so that reporting the progress and the best candidates does not
+    rescan all the tasks.
+
+    Tasks supporting add_done_callback (futures, recent IPython
+    AsyncResults) push themselves to a queue when they complete; the others
+    are polled among the pending tasks only.
+    """
+
+    def __init__(self):
+        self.n_total = 0
+        self.n_completed = 0
+        self.groups = []
+        self.ranked_fraction = None
+        # (train_fraction, parameter name, repr(value)) -> [(val, train)]
+        self.marginals = {}
+        self._done = deque()
+        self._pending = []
+
+    def add_group(self, params, train_fraction, task_group):
+        """Track the evaluation tasks of params on each CV split"""
+        group_index = len(self.groups)
+        self.groups.append(dict(params=params, train_fraction=train_fraction,
+                                n=0, val_sum=0., val_sum_sq=0.,
+                                train_sum=0., train_sum_sq=0.))
+        for task in task_group:
+            self.n_total += 1
+            if hasattr(task, 'add_done_callback'):
+                # deque.append is atomic: safe from the executor threads
+                task.add_done_callback(
+                    lambda t, i=group_index: self._done.append((i, t)))
+            else:
+                self._pending.append((group_index, task))
+
+    def update(self):
+        """Fold the evaluations completed since the last update"""
+        while self._done:
+            self._collect(*self._done.popleft())
+        if self._pending:
+            pending = []
+            for group_index, task in self._pending:
+                if task.ready():
+                    self._collect(group_index, task)
+                elif not is_aborted(task):
+                    pending.append((group_index, task))
+            self._pending = pending
+        return self
+
+    def _collect(self, group_index, task):
+        if is_aborted(task):
+            return
+        evaluation = Evaluation(*task.get())
+        group = self.groups[group_index]
+        val, train = evaluation.validation_score, evaluation.train_score
+        group['n'] += 1
+        group['val_sum'] += val
+        group['val_sum_sq'] += val ** 2
+        group['train_sum'] += train
+        group['train_sum_sq'] += train ** 2
+        self.n_completed += 1
+
+        fraction = group['train_fraction']
+        if self.ranked_fraction is None or fraction > self.ranked_fraction:
+            # Only rank candidates evaluated on the largest training sets
+            self.ranked_fraction = fraction
+        for name, value in group['params'].items():
+            self.marginals.setdefault(
+                (fraction, name, repr(value)), []).append((val, train))
+
+    def bests(self, n_top=5):
+        """Mean and standard error of the scores of the best candidates"""
+        mean_scores = []
+        for group in self.groups:
+            if group['n'] == 0 or group['train_fraction'] != self.ranked_fraction:
+                continue
+            val_mean, val_sem = _mean_sem(
+                group['n'], group['val_sum'], group['val_sum_sq'])
+            train_mean, train_sem = _mean_sem(
+                group['n'], group['train_sum'], group['train_sum_sq'])
+            mean_scores.append((val_mean, val_sem, train_mean, train_sem,
+                                group['params']))
+
+        # Don't compare the parameter dicts on ties
+        return sorted(mean_scores, key=lambda s: s[:4], reverse=True)[:n_top]
+
+    def curves(self):
+        """Partial learning curves of the candidates evaluated so far
+
+        Return a list of (params, curve) where curve lists the
+        (train_fraction, val_mean, val_sem, train_mean, train_sem) of the
+        completed evaluations, by increasing train_fraction.
+        """
+        curves = {}
+        for group in self.groups:
+            if group['n'] == 0:
+                continue
+            key = repr(sorted(group['params'].items()))
+            params, curve = curves.setdefault(key, (group['params'], []))
+            val_mean, val_sem = _mean_sem(
+                group['n'], group['val_sum'], group['val_sum_sq'])
+            train_mean, train_sem = _mean_sem(
+                group['n'], group['train_sum'], group['train_sum_sq'])
+            curve.append((group['train_fraction'], val_mean, val_sem,
+                          train_mean, train_sem))
+        return [(params, sorted(curve)) for params, curve in curves.values()]
+
+    def scores_for(self, name, value):
+        """Validation and train scores of the candidates with name=value"""
+        scores = self.marginals.get(
+            (self.ranked_fraction, name, repr(value)), [])
+        return [val for val, _ in scores], [train for _, train in scores]
+
+
+def _mean_sem(n, total, total_sq):
+    """Mean and standard error of the mean (as scipy.stats.sem) from sums"""
+    mean = total / n
+    if n < 2:
+        return mean, np.nan
+    variance = max(total_sq - n * mean ** 2, 0.) / (n - 1)
+    return mean, np.sqrt(variance / n)
+
+
+def extrapolate_learning_curve(train_fractions, scores, train_fraction):
+    """Predict the score at train_fraction from the start of a learning curve
+
+    The error rate 1 - score is modeled as a power law of the training set
+    size: a straight line in log-log scale fitted on the observed points.
+    """
+    errors = 1 - np.asarray(scores, dtype=np.float64)
+    if len(errors) < 2:
+        return np.inf
+    if np.any(errors <= 0):
+        # Perfect score already reached
+        return max(scores)
+    slope, intercept = np.polyfit(np.log(train_fractions), np.log(errors), 1)
+    return 1 - np.exp(intercept + slope * np.log(train_fraction))
+
+
+class TPESampler(object):
+    """Propose parameters with a Tree-structured Parzen Estimator
+
+    Each parameter is drawn independently. Its distribution is either a
+    list of values or an object with an `rvs` method such as the frozen
+    distributions of scipy.stats. The completed trials are split into the
+    `gamma` best ones and the others; candidates are sampled from a Parzen
+    density fitted on the best trials and the one maximizing the ratio of
+    the densities of the best over the other trials is proposed.
+    """
+
+    def __init__(self, param_distributions, gamma=0.25, n_ei_candidates=24,
+                 random_state=None, n_reference=1000):
+        self.param_distributions = param_distributions
+        self.gamma = gamma
+        self.n_ei_candidates = n_ei_candidates
+        self.random_state = check_random_state(random_state)
+
+        # Infer the scale and the support of the continuous distributions
+        # from a reference sample of their prior
+        self._scales = {}
+        for name, dist in param_distributions.items():
+            if not hasattr(dist, 'rvs'):
+                continue
+            reference = np.asarray(dist.rvs(size=n_reference,
+                                            random_state=self.random_state))
+            integer = reference.dtype.kind in 'iu'
+            log = reference.min() > 0 and reference.max() > 100 * reference.min()
+            if log:
+                reference = np.log(reference)
+            self._scales[name] = (log, integer, reference.min(),
+                                  reference.max(), reference.std())
+
+    def sample_prior(self):
+        """Draw parameters from the prior distributions"""
+        params = {}
+        for name, dist in sorted(self.param_distributions.items()):
+            if hasattr(dist, 'rvs'):
+                params[name] = dist.rvs(random_state=self.random_state)
+            else:
+                params[name] = dist[self.random_state.randint(len(dist))]
+        return params
+
+    def propose(self, trials):
+        """Propose parameters given a list of (params, score) trials"""
+        n_good = int(np.ceil(self.gamma * len(trials)))
+        if n_good == 0 or n_good == len(trials):
+            return self.sample_prior()
+        trials = sorted(trials, key=lambda t: t[1], reverse=True)
+        good = [params for params, _ in trials[:n_good]]
+        bad = [params for params, _ in trials[n_good:]]
+
+        params = {}
+        for name, dist in sorted(self.param_distributions.items()):
+            if hasattr(dist, 'rvs'):
+                params[name] = self._propose_continuous(
+                    name, [p[name] for p in good], [p[name] for p in bad])
+            else:
+                params[name] = self._propose_categorical(
+                    dist, [p[name] for p in good], [p[name] for p in bad])
+        return params
+
+    def _propose_categorical(self, values, good, bad):
+        # Laplace smoothed frequencies of the values in each set of trials
+        l = np.array([1. + good.count(v) for v in values])
+        g = np.array([1. + bad.count(v) for v in values])
+        l /= l.sum()
+        g /= g.sum()
+        candidates = self.random_state.choice(
+            len(values), size=self.n_ei_candidates, p=l)
+        best = candidates[np.argmax(l[candidates] / g[candidates])]
+        return values[best]
+
+    def _propose_continuous(self, name, good, bad):
+        log, integer, low, high, prior_std = self._scales[name]
+        good, bad = np.asarray(good, dtype=np.float64), np.asarray(bad, dtype=np.float64)
+        if log:
+            good, bad = np.log(good), np.log(bad)
+
+        # Sample around the best trials, with the prior as a wide component
+        # of the mixture so that the whole support stays reachable
+        l_centers, l_widths = self._parzen(good, low, high, prior_std)
+        g_centers, g_widths = self._parzen(bad, low, high, prior_std)
+        components = self.random_state.randint(
+            len(l_centers), size=self.n_ei_candidates)
+        candidates = self.random_state.normal(
+            l_centers[components], l_widths[components])
+        candidates = np.clip(candidates, low, high)
+        scores = (_log_mixture_density(candidates, l_centers, l_widths)
+                  - _log_mixture_density(candidates, g_centers, g_widths))
+        best = candidates[np.argmax(scores)]
+
+        if log:
+            best = np.exp(best)
+        if integer:
+            best = int(np.round(best))
+        return best
+
+    def _parzen(self, observations, low, high, prior_std):
+        """Centers and widths of a Parzen mixture including the prior"""
+        centers = np.append(observations, (low + high) / 2.)
+        # Scott's rule, bounded so that the kernels neither vanish nor
+        # cover much more than the support
+        width = prior_std * len(centers) ** (-1. / 5)
+        width = np.clip(width, (high - low) / 100., high - low)
+        widths = np.empty_like(centers)
+        widths[:-1] = width
+        widths[-1] = max(high - low, np.finfo(np.float64).tiny)
+        return centers, widths
+
+
+def _log_mixture_density(x, centers, widths):
+    """Log density of an equally weighted Gaussian mixture at points x"""
+    z = (x[:, np.newaxis] - centers) / widths
+    log_densities = -0.5 * z ** 2 - np.log(widths) - 0.5 * np.log(2 * np.pi)
+    max_log = log_densities.max(axis=1)
+    return max_log + np.log(np.exp(log_densities - max_log[:, np.newaxis]).mean(axis=1))
+
+
 class RandomizedGridSeach(object):
-    """"Async Randomized Parameter search."""
+    """"Async Randomized Parameter search.
+
+    load_balanced_view is either an IPython load balanced view or a
+    FuturesView running the evaluations locally, see `local_view`.
+    """
 
-    def __init__(self, load_balanced_view, random_state=0):
-        self.task_groups = []
+    def __init__(self, load_balanced_view, random_state=0, cache_folder=None,
+                 locality=False):
+        self.task_groups, self.all_parameters, self.train_fractions = [], [], []
+        self.results = ResultAggregator()
         self.lb_view = load_balanced_view
         self.random_state = random_state
         self._temp_files = []
 
+        # Opt-in: on a multi-host cluster, evaluate each CV split on the
+        # engines of a single host so that each host only reads its share
+        # of the files, at the cost of a coarser load balancing
+        self.locality = locality
+        self.split_targets = {}
+        self.warmings = {}
+        self._curves_state = None
+        self._model_based_state = None
+
+        # Folder, shared by all the hosts, storing one file per evaluation,
+        # keyed by the model, its parameters, the CV split and the train
+        # fraction. Evaluations found there are not scheduled again.
+        self.cache_folder = cache_folder
+        if cache_folder is not None and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        self._split_digests = {}
+
     def map_tasks(self, f, skip_aborted=True):
         if skip_aborted:
             return [f(task) for task_group in self.task_groups
@@ -91,6 +605,9 @@ class RandomizedGridSeach(object):
                             for task in task_group]
 
     def abort(self):
+        # Stop scheduling the tasks that depend on the running ones
+        self._curves_state = None
+        self._model_based_state = None
         for task_group in self.task_groups:
             for task in task_group:
                 if not task.ready() and not is_aborted(task):
@@ -101,16 +618,20 @@ class RandomizedGridSeach(object):
         return self
 
     def wait(self):
+        # Learning curves schedule new tasks as the previous ones complete
+        while self.step():
+            time.sleep(0.1)
         self.map_tasks(lambda t: t.wait(), skip_aborted=True)
         return self
 
     def completed(self):
-        return sum(self.map_tasks(lambda t: t.ready(), skip_aborted=True))
+        return self.results.update().n_completed
 
     def total(self):
-        return sum(self.map_tasks(lambda t: 1, skip_aborted=False))
+        return self.results.n_total
 
     def progress(self):
+        self.step()
         c = self.completed()
         if c == 0:
             return 0.0
@@ -122,7 +643,11 @@ class RandomizedGridSeach(object):
         self.abort()
 
         # Schedule a new batch of evalutation tasks
-        self.task_groups, self.all_parameters = [], []
+        self.task_groups, self.all_parameters, self.train_fractions = [], [], []
+        self.results = ResultAggregator()
+        self.split_targets = {}
+        self._curves_state = None
+        self._model_based_state = None
 
         # Collect temporary files:
         for filename in self._temp_files:
@@ -130,8 +655,17 @@ class RandomizedGridSeach(object):
         del self._temp_files[:]
 
     def launch_for_splits(self, model, parameter_grid, cv_split_filenames,
-        pre_warm=True, collect_files_on_reset=False):
-        """Launch a Grid Search on precomputed CV splits."""
+        pre_warm=True, collect_files_on_reset=False, path_param=None,
+        warm_start_path=False):
+        """Launch a Grid Search on precomputed CV splits.
+
+        If path_param is the name of one of the parameters of the grid, each
+        task evaluates all its values on a split in turn, loading the split
+        once. With warm_start_path=True the model is also fitted with
+        warm_start=True along the path: only use it for parameters where
+        refitting from the previous solution is valid, such as C of linear
+        models or n_estimators of ensembles.
+        """
 
         # Abort any existing processing and erase previous state
         self.reset()
@@ -141,57 +675,443 @@ class RandomizedGridSeach(object):
         if collect_files_on_reset:
             self._temp_files.extend(cv_split_filenames)
 
-        # Warm the OS disk cache on each host with sequential reads instead
-        # of having concurrent evaluation tasks compete for the the same host
-        # disk resources later.
+        # Warm the OS disk cache on each host with read ahead instead of
+        # having concurrent evaluation tasks compete for the the same host
+        # disk resources later. The warming runs concurrently with the
+        # first tasks.
         if pre_warm:
-            warm_mmap_on_cv_splits(self.lb_view.client, cv_split_filenames)
+            self._warm(cv_split_filenames)
 
-        # Randomize the grid order
-        random_state = check_random_state(self.random_state)
-        self.all_parameters = list(ParameterGrid(parameter_grid))
-        random_state.shuffle(self.all_parameters)
+        if path_param is None:
+            for params in self._shuffled_grid(parameter_grid):
+                self._launch_group(model, params, cv_split_filenames)
+        else:
+            other_params = dict((name, values) for name, values
+                                in parameter_grid.items()
+                                if name != path_param)
+            for params in self._shuffled_grid(other_params):
+                self._launch_path(model, params, path_param,
+                                  parameter_grid[path_param],
+                                  cv_split_filenames,
+                                  warm_start_path=warm_start_path)
 
-        for params in self.all_parameters:
-            task_group = []
+        # Make it possible to chain method calls
+        return self
 
-            for cv_split_filename in cv_split_filenames:
-                task = self.lb_view.apply(compute_evaluation,
-                    model, cv_split_filename, params=params)
-                task_group.append(task)
+    def launch_successive_halving(self, model, parameter_grid,
+        cv_split_filenames, min_train_fraction=0.1, eta=3, pre_warm=True,
+        collect_files_on_reset=False):
+        """Launch a Successive Halving search on precomputed CV splits.
 
-            self.task_groups.append(task_group)
+        All the candidates are first evaluated on `min_train_fraction` of
+        the training sets. Only the best `1 / eta` of them are promoted to
+        be evaluated again on `eta` times larger training sets, and so on
+        until the full training sets are reached.
 
-        # Make it possible to chain method calls
+        This call blocks until the candidates of the last round are known.
+        The evaluations of this last round, on the full training sets, are
+        left running asynchronously like the ones of `launch_for_splits`.
+        """
+        self.reset()
+        self.parameter_grid = parameter_grid
+        if collect_files_on_reset:
+            self._temp_files.extend(cv_split_filenames)
+        if pre_warm:
+            self._warm(cv_split_filenames)
+
+        candidates = self._shuffled_grid(parameter_grid)
+        train_fraction = min_train_fraction
+        if len(candidates) == 1:
+            train_fraction = 1.0
+        while True:
+            task_groups = [self._launch_group(model, params, cv_split_filenames,
+                                              train_fraction=train_fraction)
+                           for params in candidates]
+            if train_fraction >= 1.0:
+                break
+
+            # Wait for the end of the round and promote the best candidates
+            # to the next one: the others are never scheduled again.
+            mean_scores = []
+            for i, task_group in enumerate(task_groups):
+                evaluations = [Evaluation(*t.get()) for t in task_group]
+                val_scores = [e.validation_score for e in evaluations]
+                mean_scores.append((np.mean(val_scores), i))
+            n_promoted = max(1, len(candidates) // eta)
+            candidates = [candidates[i]
+                          for _, i in sorted(mean_scores, reverse=True)]
+            candidates = candidates[:n_promoted]
+            train_fraction = min(1.0, train_fraction * eta)
+            if len(candidates) == 1:
+                # Nothing left to compare: evaluate the winner on the full
+                # training sets right away
+                train_fraction = 1.0
+
+        return self
+
+    def launch_model_based(self, model, param_distributions,
+        cv_split_filenames, n_iter=50, n_initial=10, n_parallel=None,
+        gamma=0.25, pre_warm=True, collect_files_on_reset=False):
+        """Launch a sequential model-based search on precomputed CV splits.
+
+        `param_distributions` maps parameter names to lists of values or to
+        distributions with an `rvs` method, such as the ones of
+        scipy.stats. The first `n_initial` candidates are drawn at random;
+        the next ones are proposed by a TPESampler fitted on the mean
+        validation scores of the completed candidates.
+
+        Up to `n_parallel` candidates (by default as many as the engines or
+        the workers of a FuturesView) are evaluated at a time: a new one is
+        proposed as soon as all the evaluations of a previous one are
+        completed. This call does not block: the next candidates are
+        proposed by `step`, which is called by `report`, `progress` and
+        `wait`.
+        """
+        self.reset()
+        # Only the discrete parameters can be summarized by boxplots
+        self.parameter_grid = dict((name, values) for name, values
+                                   in param_distributions.items()
+                                   if not hasattr(values, 'rvs'))
+        if collect_files_on_reset:
+            self._temp_files.extend(cv_split_filenames)
+        if pre_warm:
+            self._warm(cv_split_filenames)
+        if n_parallel is None:
+            client = self.lb_view.client
+            if client is not None:
+                n_parallel = len(client)
+            else:
+                n_parallel = (getattr(self.lb_view, 'max_workers', None)
+                              or n_initial)
+
+        self._model_based_state = dict(
+            model=model, cv_split_filenames=cv_split_filenames,
+            sampler=TPESampler(param_distributions, gamma=gamma,
+                               random_state=self.random_state),
+            n_iter=n_iter, n_initial=n_initial, n_parallel=n_parallel,
+            trials=[], in_flight=[], seen=set(), n_launched=0)
+        self.step()
+        return self
+
+    def launch_learning_curves(self, model, parameter_grid,
+        cv_split_filenames, train_fractions=(0.1, 0.2, 0.4, 0.7, 1.0),
+        n_initial=2, min_gain=0.001, pre_warm=True,
+        collect_files_on_reset=False):
+        """Launch the evaluation of learning curves on precomputed CV splits.
+
+        Each candidate of the grid is evaluated on its `n_initial` smallest
+        `train_fractions` right away. Then, each time the evaluations of the
+        largest fraction of a candidate complete, its learning curve is
+        extrapolated to the next fraction which is only scheduled if the
+        predicted validation score improves by at least `min_gain`.
+
+        This call does not block: the next fractions are scheduled by
+        `step`, which is called by `learning_curves`, `progress` and `wait`,
+        so polling the partial curves also drives the search.
+        """
+        self.reset()
+        self.parameter_grid = parameter_grid
+        if collect_files_on_reset:
+            self._temp_files.extend(cv_split_filenames)
+        if pre_warm:
+            self._warm(cv_split_filenames)
+
+        train_fractions = sorted(train_fractions)
+        candidates = self._shuffled_grid(parameter_grid)
+        # Candidate index -> indices of the task groups being evaluated
+        in_flight = {}
+        for i, params in enumerate(candidates):
+            for train_fraction in train_fractions[:n_initial]:
+                self._launch_group(model, params, cv_split_filenames,
+                                   train_fraction=train_fraction)
+                in_flight.setdefault(i, []).append(len(self.task_groups) - 1)
+            if n_initial >= len(train_fractions):
+                del in_flight[i]
+
+        self._curves_state = dict(
+            model=model, candidates=candidates,
+            cv_split_filenames=cv_split_filenames,
+            train_fractions=train_fractions, min_gain=min_gain,
+            observed=[[] for _ in candidates],
+            next_fraction=[n_initial] * len(candidates),
+            in_flight=in_flight)
         return self
 
+    def step(self):
+        """Schedule the tasks waiting for the completion of previous ones
+
+        These are the next fractions of the learning curves of
+        `launch_learning_curves` and the next candidates of
+        `launch_model_based`. Return True while some remain to be scheduled.
+        """
+        return self._step_learning_curves() or self._step_model_based()
+
+    def _step_learning_curves(self):
+        """Schedule the next fractions of the completed learning curves"""
+        state = self._curves_state
+        if state is None:
+            return False
+        train_fractions = state['train_fractions']
+        in_flight = state['in_flight']
+        completed = [i for i, group_indices in in_flight.items()
+                     if all(t.ready() for g in group_indices
+                            for t in self.task_groups[g])]
+        for i in completed:
+            observed = state['observed'][i]
+            for g in in_flight.pop(i):
+                task_group = self.task_groups[g]
+                if any(is_aborted(t) for t in task_group):
+                    continue
+                evaluations = [Evaluation(*t.get()) for t in task_group]
+                observed.append((self.train_fractions[g], np.mean(
+                    [e.validation_score for e in evaluations])))
+
+            # Only schedule the next fraction if it's worth it
+            train_fraction = train_fractions[state['next_fraction'][i]]
+            if observed:
+                fractions, scores = zip(*sorted(observed))
+                predicted = extrapolate_learning_curve(
+                    fractions, scores, train_fraction)
+                if predicted - max(scores) < state['min_gain']:
+                    continue
+            self._launch_group(state['model'], state['candidates'][i],
+                               state['cv_split_filenames'],
+                               train_fraction=train_fraction)
+            state['next_fraction'][i] += 1
+            if state['next_fraction'][i] < len(train_fractions):
+                in_flight[i] = [len(self.task_groups) - 1]
+
+        if not in_flight:
+            self._curves_state = None
+        return bool(in_flight)
+
+    def _step_model_based(self):
+        """Propose new candidates in place of the completed ones"""
+        state = self._model_based_state
+        if state is None:
+            return False
+        sampler, trials, seen = state['sampler'], state['trials'], state['seen']
+        in_flight = state['in_flight']
+
+        # Fit the sampler on the candidates completed so far
+        completed = [i for i in in_flight
+                     if all(t.ready() for t in self.task_groups[i])]
+        for i in completed:
+            in_flight.remove(i)
+            task_group = self.task_groups[i]
+            if any(is_aborted(t) for t in task_group):
+                continue
+            evaluations = [Evaluation(*t.get()) for t in task_group]
+            trials.append((self.all_parameters[i], np.mean(
+                [e.validation_score for e in evaluations])))
+
+        while (state['n_launched'] < state['n_iter']
+               and len(in_flight) < state['n_parallel']):
+            if len(trials) < state['n_initial']:
+                params = sampler.sample_prior()
+            else:
+                params = sampler.propose(trials)
+            # Candidates are proposed while others are still running:
+            # avoid evaluating the same one twice
+            for _ in range(10):
+                if repr(sorted(params.items())) not in seen:
+                    break
+                params = sampler.sample_prior()
+            seen.add(repr(sorted(params.items())))
+            self._launch_group(state['model'], params,
+                               state['cv_split_filenames'])
+            in_flight.append(len(self.task_groups) - 1)
+            state['n_launched'] += 1
+
+        if state['n_launched'] == state['n_iter']:
+            self._model_based_state = None
+            return False
+        return True
+
+    def learning_curves(self):
+        """Partial learning curves of the completed evaluations
+
+        See ResultAggregator.curves.
+        """
+        self.step()
+        return self.results.update().curves()
+
+    def _warm(self, cv_split_filenames):
+        """Start warming the CV splits on the hosts that will use them"""
+        client = self.lb_view.client
+        self.split_targets = {}
+        host_filenames = None
+        if client is not None and self.locality:
+            hosts = engines_per_host(client)
+            if 1 < len(hosts) <= len(cv_split_filenames):
+                # Assign the splits to the hosts in a round robin fashion
+                host_names = sorted(hosts)
+                host_filenames = dict((host, []) for host in host_names)
+                for i, filename in enumerate(cv_split_filenames):
+                    host = host_names[i % len(host_names)]
+                    host_filenames[host].append(filename)
+                    self.split_targets[filename] = hosts[host]
+        self.warmings = warm_mmap_on_cv_splits(
+            client, cv_split_filenames, host_filenames=host_filenames,
+            block=False)
+
+    def warming_times(self):
+        """Duration in seconds of the completed cache warming of each host"""
+        return dict((host, r if isinstance(r, float) else r.get())
+                    for host, r in self.warmings.items()
+                    if isinstance(r, float) or r.ready())
+
+    def _shuffled_grid(self, parameter_grid):
+        """List the parameter combinations of the grid in random order"""
+        random_state = check_random_state(self.random_state)
+        all_parameters = list(ParameterGrid(parameter_grid))
+        random_state.shuffle(all_parameters)
+        return all_parameters
+
+    def _launch_group(self, model, params, cv_split_filenames,
+                      train_fraction=1.0):
+        """Schedule the evaluation of params on each CV split"""
+        task_group = []
+
+        for cv_split_filename in cv_split_filenames:
+            cache_filename = self._cache_filename(
+                model, params, cv_split_filename, train_fraction)
+            if cache_filename is not None and os.path.exists(cache_filename):
+                from sklearn.externals import joblib
+                task = CachedResult(joblib.load(cache_filename))
+            else:
+                task = self._apply(cv_split_filename, compute_evaluation,
+                    model, cv_split_filename, params=params,
+                    train_fraction=train_fraction,
+                    cache_filename=cache_filename)
+            task_group.append(task)
+
+        self._add_group(params, train_fraction, task_group)
+        return task_group
+
+    def _launch_path(self, model, params, path_param, path_values,
+                     cv_split_filenames, train_fraction=1.0,
+                     warm_start_path=False):
+        """Schedule the evaluation of params along the values of path_param
+
+        A single task evaluates all the values on each CV split, by
+        increasing value. One task group is still recorded per value.
+        """
+        from sklearn.externals import joblib
+        path_values = sorted(path_values)
+        all_params = [dict(params, **{path_param: value})
+                      for value in path_values]
+        task_groups = [[] for _ in path_values]
+
+        for cv_split_filename in cv_split_filenames:
+            cache_filenames = [self._cache_filename(
+                model, p, cv_split_filename, train_fraction,
+                warm_start_path=warm_start_path)
+                for p in all_params]
+            uncached = [i for i, c in enumerate(cache_filenames)
+                        if c is None or not os.path.exists(c)]
+            if uncached:
+                task = self._apply(cv_split_filename, compute_evaluation,
+                    model, cv_split_filename, params=params,
+                    train_fraction=train_fraction,
+                    cache_filename=[cache_filenames[i] for i in uncached],
+                    path=(path_param, [path_values[i] for i in uncached]),
+                    warm_start_path=warm_start_path)
+            for i, cache_filename in enumerate(cache_filenames):
+                if i in uncached:
+                    task_groups[i].append(PathResult(task, uncached.index(i)))
+                else:
+                    task_groups[i].append(
+                        CachedResult(joblib.load(cache_filename)))
+
+        for p, task_group in zip(all_params, task_groups):
+            self._add_group(p, train_fraction, task_group)
+        return task_groups
+
+    def _apply(self, cv_split_filename, f, *args, **kwargs):
+        """Schedule f on the engines assigned to the CV split, if any"""
+        if cv_split_filename in self.split_targets:
+            # Only the engines of the host warmed with this split
+            with self.lb_view.temp_flags(
+                    targets=self.split_targets[cv_split_filename]):
+                return self.lb_view.apply(f, *args, **kwargs)
+        return self.lb_view.apply(f, *args, **kwargs)
+
+    def _add_group(self, params, train_fraction, task_group):
+        self.task_groups.append(task_group)
+        self.all_parameters.append(params)
+        self.train_fractions.append(train_fraction)
+        self.results.add_group(params, train_fraction, task_group)
+
+    def _cache_filename(self, model, params, cv_split_filename,
+                        train_fraction, warm_start_path=False):
+        """Path of the cached evaluation, None if caching is disabled"""
+        if self.cache_folder is None:
+            return None
+        from sklearn.externals import joblib
+
+        model_params = model.get_params(deep=False)
+        model_params.update(params)
+        key = (type(model).__module__, type(model).__name__,
+               model_params, self._split_digest(cv_split_filename),
+               train_fraction)
+        if warm_start_path:
+            # Not interchangeable with the evaluations of cold fits
+            key += ('warm_start_path',)
+        key = joblib.hash(key)
+        return os.path.join(self.cache_folder, key + '.pkl')
+
+    def _split_digest(self, cv_split_filename):
+        """Digest of a CV split, including the dataset of index based splits"""
+        # The split file is only loaded once to find its dataset file
+        stat = os.stat(cv_split_filename)
+        split_key = ('split', os.path.abspath(cv_split_filename),
+                     stat.st_size, stat.st_mtime)
+        if split_key not in self._split_digests:
+            from sklearn.externals import joblib
+            cv_split = joblib.load(cv_split_filename, mmap_mode='r')
+            data_filename = None
+            if len(cv_split) == 3:
+                data_filename = os.path.join(
+                    os.path.dirname(cv_split_filename), cv_split[0])
+            self._split_digests[split_key] = (
+                self._file_digest(cv_split_filename), data_filename)
+
+        digest, data_filename = self._split_digests[split_key]
+        if data_filename is None:
+            return digest
+        return digest + '-' + self._file_digest(data_filename)
+
+    def _file_digest(self, filename):
+        # Hash the content of the file rather than its name, only once per
+        # file as long as it's not modified
+        stat = os.stat(filename)
+        digest_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if digest_key not in self._split_digests:
+            self._split_digests[digest_key] = file_digest(filename)
+        return self._split_digests[digest_key]
+
     def launch_for_arrays(self, model, parameter_grid, X, y, n_cv_iter=5, train_size=None,
                           test_size=0.25, pre_warm=True, folder=".", name=None,
-                          random_state=None):
+                          random_state=None, indices=False, path_param=None,
+                          warm_start_path=False):
         cv_split_filenames = persist_cv_splits(
             X, y, n_cv_iter=n_cv_iter, train_size=train_size, test_size=test_size,
-            name=name, folder=folder, random_state=random_state)
-        return self.launch_for_splits(model, parameter_grid,
-            cv_split_filenames, pre_warm=pre_warm, collect_files_on_reset=True)
+            name=name, folder=folder, random_state=random_state,
+            indices=indices)
+        self.launch_for_splits(model, parameter_grid,
+            cv_split_filenames, pre_warm=pre_warm, collect_files_on_reset=True,
+            path_param=path_param, warm_start_path=warm_start_path)
+        if indices:
+            # The shared dataset file is collected along with the splits
+            from sklearn.externals import joblib
+            self._temp_files.append(os.path.join(folder, joblib.load(
+                cv_split_filenames[0], mmap_mode='r')[0]))
+        return self
 
     def find_bests(self, n_top=5):
         """Compute the mean score of the completed tasks"""
-        mean_scores = []
-
-        for params, task_group in zip(self.all_parameters, self.task_groups):
-            evaluations = [Evaluation(*t.get())
-                           for t in task_group
-                           if t.ready() and not is_aborted(t)]
-
-            if len(evaluations) == 0:
-                continue
-            val_scores = [e.validation_score for e in evaluations]
-            train_scores = [e.train_score for e in evaluations]
-            mean_scores.append((np.mean(val_scores), sem(val_scores),
-                                np.mean(train_scores), sem(train_scores),
-                                params))
-
-        return sorted(mean_scores, reverse=True)[:n_top]
+        return self.results.update().bests(n_top=n_top)
 
     def report(self, n_top=5):
         bests = self.find_bests(n_top=n_top)
@@ -209,10 +1129,7 @@ class RandomizedGridSeach(object):
     def boxplot_parameters(self, display_train=False):
         """Plot boxplot for each parameters independently"""
         import pylab as pl
-        results = [Evaluation(*task.get())
-                   for task_group in self.task_groups
-                   for task in task_group
-                   if task.ready() and not is_aborted(task)]
+        self.results.update()
 
         n_rows = len(self.parameter_grid)
         pl.figure()
@@ -221,12 +1138,9 @@ class RandomizedGridSeach(object):
             val_scores_per_value = []
             train_scores_per_value = []
             for param_value in param_values:
-                train_scores = [r.train_score for r in results
-                                if r.parameters[param_name] == param_value]
+                val_scores, train_scores = self.results.scores_for(
+                    param_name, param_value)
                 train_scores_per_value.append(train_scores)
-
-                val_scores = [r.validation_score for r in results
-                              if r.parameters[param_name] == param_value]
                 val_scores_per_value.append(val_scores)
 
             widths = 0.25
@@ -243,3 +1157,14 @@ class RandomizedGridSeach(object):
             pl.xticks(np.arange(len(param_values)) + 1, param_values)
             pl.xlabel(param_name)
             pl.ylabel("Val. Score")
+
+    def plot_learning_curves(self):
+        """Plot the validation learning curve of each candidate"""
+        import pylab as pl
+        pl.figure()
+        for params, curve in self.learning_curves():
+            fractions, val_means, val_sems = list(zip(*curve))[:3]
+            pl.errorbar(fractions, val_means, yerr=val_sems, label=str(params))
+        pl.xlabel("Train fraction")
+        pl.ylabel("Val. Score")
+        pl.legend(loc='best')
@@ -0,0 +1,48 @@
+"""
+Benchmark the speedup of `RBM.train_parallel` versus the number of worker processes.
+
+Usage: python benchmark_parallel.py [num_examples] [max_jobs]
+"""
+from __future__ import print_function
+import os
+import sys
+
+# One BLAS thread per process, so that the speedup comes from the worker processes only. This has
+# to be set before numpy is imported.
+for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+  os.environ[var] = '1'
+
+from time import time
+import multiprocessing
+import numpy as np
+
+from rbm import RBM
+
+NUM_VISIBLE = 784
+NUM_HIDDEN = 256
+BATCH_SIZE = 100
+MAX_EPOCHS = 3
+
+if __name__ == '__main__':
+  num_examples = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  max_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+
+  rng = np.random.default_rng(0)
+  data = (rng.random((num_examples, NUM_VISIBLE)) < 0.1).astype(np.float32)
+
+  r = RBM(NUM_VISIBLE, NUM_HIDDEN, random_state = 0, dtype = np.float32)
+  t0 = time()
+  r.train(data, max_epochs = MAX_EPOCHS, batch_size = BATCH_SIZE, callbacks = [])
+  serial_time = time() - t0
+  print("%d examples, %d epochs, batch size %d" % (num_examples, MAX_EPOCHS, BATCH_SIZE))
+  print("serial train: %.2fs" % serial_time)
+
+  n_jobs = 1
+  while n_jobs <= max_jobs:
+    r = RBM(NUM_VISIBLE, NUM_HIDDEN, random_state = 0, dtype = np.float32)
+    t0 = time()
+    r.train_parallel(data, n_jobs = n_jobs, max_epochs = MAX_EPOCHS, batch_size = BATCH_SIZE,
+                     callbacks = [])
+    parallel_time = time() - t0
+    print("n_jobs=%2d: %.2fs, speedup %.2fx" % (n_jobs, parallel_time, serial_time / parallel_time))
+    n_jobs *= 2
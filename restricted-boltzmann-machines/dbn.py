@@ -0,0 +1,152 @@
+from __future__ import print_function
+import atexit
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+import numpy as np
+from scipy import sparse
+
+from rbm import RBM
+
+class DBN(object):
+  """
+  A deep belief network: a stack of RBMs pretrained greedily, one layer at a time, where the hidden
+  states of each layer (as sampled by `run_visible`) are the training data of the next one.
+
+  The hidden states of every layer are cached to memory-mapped files in `cache_folder`, keyed by the
+  weights of the layers below and by the training data, so that re-training the upper layers reuses
+  the outputs of the lower ones instead of recomputing them. Only the latest output of each layer is
+  kept. The cache files are named after an id of the network, so several networks can share a folder.
+  """
+
+  def __init__(self, layer_sizes, learning_rate = 0.1, random_state = None, dtype = np.float64, cache_folder = None):
+    """
+    Parameters
+    ----------
+    layer_sizes: The number of units of each layer, starting with the visible units.
+    cache_folder: Folder of the cached layer outputs, created if it does not exist. By default a
+      temporary folder, removed when the interpreter exits.
+    """
+    rng = np.random.default_rng(random_state)
+    self.layers = [RBM(num_visible, num_hidden, learning_rate, random_state = rng.integers(2 ** 31), dtype = dtype)
+                   for num_visible, num_hidden in zip(layer_sizes[:-1], layer_sizes[1:])]
+    self.dtype = np.dtype(dtype)
+    if cache_folder is None:
+      cache_folder = tempfile.mkdtemp(prefix = 'dbn_cache_')
+      atexit.register(shutil.rmtree, cache_folder, True)
+    elif not os.path.exists(cache_folder):
+      os.makedirs(cache_folder)
+    self.cache_folder = cache_folder
+    self.network_id = uuid.uuid4().hex
+
+  def pretrain(self, data, max_epochs = 1000, start_layer = 0, chunk_size = 10000, **kwargs):
+    """
+    Train the layers from `start_layer` upwards, each on the hidden states of the layer below.
+
+    Parameters
+    ----------
+    data: The training examples, in any of the forms accepted by `RBM.train` except a one-shot
+      iterator, as they are read several times.
+    max_epochs: Number of epochs of training of each layer.
+    start_layer: Index of the first layer to train. The layers below are left as they are and their
+      outputs are read back from the cache when available.
+    chunk_size: Number of rows propagated at once when computing the outputs of a layer.
+    kwargs: The other training options of `RBM.train`.
+    """
+    inputs = data
+    data_digest = self._data_digest(data, chunk_size)
+    for i, rbm in enumerate(self.layers):
+      if i >= start_layer:
+        rbm.train(inputs, max_epochs = max_epochs, **kwargs)
+      if i + 1 < len(self.layers):
+        inputs = self.layer_output(i, data, chunk_size = chunk_size, data_digest = data_digest)
+
+  def layer_output(self, layer, data, chunk_size = 10000, data_digest = None):
+    """
+    Return the hidden states of `layer` given the training examples `data`, as a read-only memory-mapped
+    array. The output is computed chunk by chunk from the cached output of the layer below, and cached
+    in turn.
+
+    Parameters
+    ----------
+    data_digest: The digest of `data` computed by `_data_digest`, to avoid hashing the data again.
+    """
+    if data_digest is None:
+      data_digest = self._data_digest(data, chunk_size)
+    if layer == 0:
+      inputs = data
+    else:
+      inputs = self.layer_output(layer - 1, data, chunk_size = chunk_size, data_digest = data_digest)
+
+    rbm = self.layers[layer]
+    prefix = 'dbn_%s_layer_%d_' % (self.network_id, layer)
+    filename = os.path.join(self.cache_folder, prefix + self._cache_key(layer, data_digest) + '.mmap')
+    if not os.path.exists(filename):
+      # The outputs of the previous weights or data are not used anymore
+      for stale_filename in glob.glob(os.path.join(self.cache_folder, prefix + '*.mmap')):
+        os.remove(stale_filename)
+      # Write to a temporary file first, so that an interrupted run does not leave a truncated cache.
+      tmp_filename = filename + '.tmp'
+      with open(tmp_filename, 'wb') as f:
+        for chunk in self._chunks(rbm, inputs, chunk_size):
+          f.write(rbm.run_visible(chunk).tobytes())
+      os.rename(tmp_filename, filename)
+
+    num_rows = os.path.getsize(filename) // (rbm.num_hidden * self.dtype.itemsize)
+    return np.memmap(filename, dtype = self.dtype, mode = 'r', shape = (num_rows, rbm.num_hidden))
+
+  def transform(self, data):
+    """Propagate `data` through all the layers, returning the hidden states of the top layer."""
+    for rbm in self.layers:
+      data = rbm.run_visible(data)
+    return data
+
+  def _chunks(self, rbm, data, chunk_size):
+    """Iterate over `data`, in any of the forms accepted by `RBM.train`, in chunks of rows."""
+    data = rbm._training_source(data, 1)
+    if callable(data):
+      for chunk in data():
+        yield chunk
+    else:
+      for start in range(0, data.shape[0], chunk_size):
+        yield data[start:start + chunk_size]
+
+  def _cache_key(self, layer, data_digest):
+    """Hash the weights of the layers up to `layer` and the digest of the data."""
+    h = hashlib.md5()
+    for rbm in self.layers[:layer + 1]:
+      for param in (rbm.connection_weights, rbm.visible_bias, rbm.hidden_bias):
+        h.update(np.ascontiguousarray(param).tobytes())
+    h.update(data_digest.encode('utf-8'))
+    return h.hexdigest()
+
+  def _data_digest(self, data, chunk_size = 10000):
+    """
+    Hash the whole of `data`: the name, size and modification time of a file, or else all the rows, read
+    chunk by chunk.
+    """
+    h = hashlib.md5()
+    if isinstance(data, str):
+      stat = os.stat(data)
+      h.update(('%s %d %r' % (os.path.abspath(data), stat.st_size, stat.st_mtime)).encode('utf-8'))
+      return h.hexdigest()
+    for chunk in self._chunks(self.layers[0], data, chunk_size):
+      if sparse.issparse(chunk):
+        chunk = chunk.tocsr()
+        h.update(str((chunk.shape, chunk.dtype.str)).encode('utf-8'))
+        for array in (chunk.data, chunk.indices, chunk.indptr):
+          h.update(np.ascontiguousarray(array).tobytes())
+      else:
+        chunk = np.asarray(chunk)
+        h.update(str((chunk.shape, chunk.dtype.str)).encode('utf-8'))
+        h.update(np.ascontiguousarray(chunk).tobytes())
+    return h.hexdigest()
+
+if __name__ == '__main__':
+  dbn = DBN([6, 4, 2])
+  training_data = np.array([[1,1,1,0,0,0],[1,0,1,0,0,0],[1,1,1,0,0,0],[0,0,1,1,1,0], [0,0,1,1,0,0],[0,0,1,1,1,0]])
+  dbn.pretrain(training_data, max_epochs = 1000, callbacks = [])
+  print(dbn.transform(training_data))
@@ -1,100 +1,454 @@
 from __future__ import print_function
+from timeit import default_timer
+import itertools
+import os
 import numpy as np
+from scipy import sparse
+from scipy.special import expit
 
-class RBM:
-  
-  def __init__(self, num_visible, num_hidden, learning_rate = 0.1):
+# The learned parameters of an RBM.
+_PARAMETERS = ('connection_weights', 'visible_bias', 'hidden_bias')
+
+class RBM(object):
+
+  def __init__(self, num_visible, num_hidden, learning_rate = 0.1, random_state = None, dtype = np.float64):
+    self._init_attributes(num_visible, num_hidden, learning_rate, random_state, dtype)
+
+    # Initialize a weight matrix, of dimensions (num_visible x num_hidden), using
+    # a Gaussian distribution with mean 0 and standard deviation 0.1.
+    self.connection_weights = 0.1 * self.rng.standard_normal((self.num_visible, self.num_hidden), dtype = self.dtype)
+    # The weights of the bias unit are kept in separate vectors, so that the data never has to be
+    # copied just to prepend a column of ones to it.
+    self.visible_bias = np.zeros(self.num_visible, dtype = self.dtype)
+    self.hidden_bias = np.zeros(self.num_hidden, dtype = self.dtype)
+
+  def _init_attributes(self, num_visible, num_hidden, learning_rate, random_state, dtype):
+    """Set the attributes of the machine other than its parameters."""
     self.num_hidden = num_hidden
     self.num_visible = num_visible
     self.learning_rate = learning_rate
+    self.rng = np.random.default_rng(random_state)
+    # Floating point type of the weights, the work arrays and the random draws. np.float32 halves
+    # the memory bandwidth of every epoch.
+    self.dtype = np.dtype(dtype)
 
-    # Initialize a weight matrix, of dimensions (num_visible x num_hidden), using
-    # a Gaussian distribution with mean 0 and standard deviation 0.1.
-    self.weights = 0.1 * np.random.randn(self.num_visible, self.num_hidden)    
-    # Insert weights for the bias units into the first row and first column.
-    self.weights = np.insert(self.weights, 0, 0, axis = 0)
-    self.weights = np.insert(self.weights, 0, 0, axis = 1)
+    # Work arrays reused across epochs and calls, see `_buffer`.
+    self._buffers = {}
+
+  @property
+  def weights(self):
+    """
+    The full weight matrix, of dimensions (num_visible + 1 x num_hidden + 1), with the weights of the
+    bias unit in the first row and first column.
+    """
+    weights = np.zeros((self.num_visible + 1, self.num_hidden + 1), dtype = self.dtype)
+    weights[1:,1:] = self.connection_weights
+    weights[1:,0] = self.visible_bias
+    weights[0,1:] = self.hidden_bias
+    return weights
+
+  @weights.setter
+  def weights(self, weights):
+    self.connection_weights = np.array(weights[1:,1:], dtype = self.dtype)
+    self.visible_bias = np.array(weights[1:,0], dtype = self.dtype)
+    self.hidden_bias = np.array(weights[0,1:], dtype = self.dtype)
+
+  def __getstate__(self):
+    # Don't pickle the work arrays.
+    state = self.__dict__.copy()
+    state['_buffers'] = {}
+    return state
+
+  def save(self, path):
+    """
+    Save the machine to the folder `path`: each parameter array is stored as a raw .npy file that
+    `load` can memory-map, and the other attributes in a small JSON header.
+    """
+    import json
+    if not os.path.exists(path):
+      os.makedirs(path)
+    for name in _PARAMETERS:
+      np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+    header = dict(format_version = 1, num_visible = self.num_visible, num_hidden = self.num_hidden,
+                  learning_rate = self.learning_rate, dtype = self.dtype.str)
+    with open(os.path.join(path, 'header.json'), 'w') as f:
+      json.dump(header, f, indent = 2)
 
-  def train(self, data, max_epochs = 1000):
+  @classmethod
+  def load(cls, path, mmap_mode = None):
+    """
+    Load a machine saved by `save`. With `mmap_mode = 'r'`, the parameters are memory-mapped read-only
+    rather than read, so that processes loading the same model share a single copy of the weights
+    in the page cache. Such a machine can be used for inference but not trained.
+    """
+    import json
+    with open(os.path.join(path, 'header.json')) as f:
+      header = json.load(f)
+    if header['format_version'] != 1:
+      raise ValueError("Unsupported RBM format version: %r" % header['format_version'])
+    # Skip __init__: the random initial weights would only be discarded.
+    rbm = cls.__new__(cls)
+    rbm._init_attributes(header['num_visible'], header['num_hidden'], header['learning_rate'], None, header['dtype'])
+    for name in _PARAMETERS:
+      setattr(rbm, name, np.load(os.path.join(path, name + '.npy'), mmap_mode = mmap_mode))
+    return rbm
+
+  def train(self, data, max_epochs = 1000, batch_size = None, momentum = 0.0, weight_decay = 0.0,
+            persistent = False, shuffle = True, callbacks = None):
     """
     Train the machine.
 
     Parameters
     ----------
-    data: A matrix where each row is a training example consisting of the states of visible units.    
+    data: The training examples, each row consisting of the states of visible units. Either
+      - a matrix, possibly a `np.memmap`, which is then read one contiguous batch at a time, or a list
+        of rows;
+      - a `scipy.sparse` matrix, whose batches stay sparse so that the positive phase costs time in
+        proportion to the number of non-zero entries;
+      - the filename of a .npy file or of an array saved with joblib, which is memory-mapped. If the
+        file holds a tuple, such as the CV splits written by `persist_cv_splits`, its first array is used
+        (the training rows, gathered in memory, for index based splits);
+      - a callable returning an iterable of row chunks, called again at each epoch, so that
+        arbitrarily large data can be streamed from a generator;
+      - an iterator or a generator of row chunks, which can only be used for a single epoch.
+      Each batch is converted to `dtype` as it is read, so the data is never copied as a whole.
+    max_epochs: Number of passes over the whole data matrix.
+    batch_size: Number of training examples per weight update. Defaults to the whole data matrix
+      (full-batch CD-1), or to each chunk when streaming.
+    momentum: Fraction of the previous weight update added to the current one.
+    weight_decay: L2 penalty applied to the connection weights (not to the bias weights).
+    persistent: If True, use persistent contrastive divergence (PCD): the negative phase starts from
+      a set of fantasy particles that are kept between batches instead of from the data.
+    shuffle: Whether to visit the training examples in a new random order at each epoch. Memory-mapped
+      data is shuffled by batch rather than by row, to keep the disk reads sequential.
+    callbacks: Callables invoked as `callback(rbm, epoch, sample)` at the end of each epoch, where
+      `sample` holds up to `callback.sample_size` training examples drawn once before training. The
+      training stops early as soon as a callback returns True. Defaults to a `Monitor` printing the
+      reconstruction error every 10 epochs; pass an empty list to train silently.
+
+    The cumulative time spent in the positive phase, the negative phase and the weight updates is
+    recorded in `self.timings`.
+    """
+
+    data = self._training_source(data, max_epochs)
+    if callbacks is None:
+      callbacks = [Monitor()]
+    sample = self._sample_rows(data, max([getattr(c, 'sample_size', 0) for c in callbacks] + [0]))
+    self.timings = dict(positive = 0.0, negative = 0.0, update = 0.0)
+
+    # The work arrays are cached by `_buffer` and filled in place, so that the epoch loop does not
+    # allocate anything proportional to the size of the data.
+    pos_associations = self._buffer('pos_associations', self.num_visible, self.num_hidden)
+    neg_associations = self._buffer('neg_associations', self.num_visible, self.num_hidden)
+    pos_visible_sums = np.empty(self.num_visible, dtype = self.dtype)
+    neg_visible_sums = np.empty(self.num_visible, dtype = self.dtype)
+    pos_hidden_sums = np.empty(self.num_hidden, dtype = self.dtype)
+    neg_hidden_sums = np.empty(self.num_hidden, dtype = self.dtype)
+
+    # Previous weight updates, used for momentum.
+    velocity = np.zeros_like(self.connection_weights)
+    visible_bias_velocity = np.zeros_like(self.visible_bias)
+    hidden_bias_velocity = np.zeros_like(self.hidden_bias)
+
+    # Hidden states of the fantasy particles used by PCD, one particle per example in the first batch.
+    fantasy_hidden_states = None
+
+    for epoch in range(max_epochs):
+      for batch in self._batches(data, batch_size, shuffle):
+        t0 = default_timer()
+        num_batch = batch.shape[0]
+        pos_hidden_probs = self._buffer('pos_hidden_probs', num_batch, self.num_hidden)
+        pos_hidden_states = self._buffer('pos_hidden_states', num_batch, self.num_hidden)
+
+        # Clamp to the data and sample from the hidden units.
+        # (This is the "positive CD phase", aka the reality phase.)
+        self._hidden_probs(batch, pos_hidden_probs)
+        self._sample(pos_hidden_probs, pos_hidden_states, 'hidden_noise')
+        # Note that we're using the activation *probabilities* of the hidden states, not the hidden states
+        # themselves, when computing associations. We could also use the states; see section 3 of Hinton's
+        # "A Practical Guide to Training Restricted Boltzmann Machines" for more.
+        self._dot(batch.T, pos_hidden_probs, pos_associations)
+        self._column_sums(batch, pos_visible_sums)
+        np.sum(pos_hidden_probs, axis = 0, out = pos_hidden_sums)
+        t1 = default_timer()
+
+        # Reconstruct the visible units and sample again from the hidden units.
+        # (This is the "negative CD phase", aka the daydreaming phase.)
+        # With PCD the chain is not restarted at the data but continues from the fantasy particles.
+        if persistent:
+          if fantasy_hidden_states is None:
+            fantasy_hidden_states = np.empty((num_batch, self.num_hidden), dtype = self.dtype)
+            np.less(self.rng.random((num_batch, self.num_hidden), dtype = self.dtype), 0.5, out = fantasy_hidden_states)
+          neg_hidden_start = fantasy_hidden_states
+        else:
+          neg_hidden_start = pos_hidden_states
+        num_particles = neg_hidden_start.shape[0]
+        neg_visible_probs = self._buffer('neg_visible_probs', num_particles, self.num_visible)
+        neg_hidden_probs = self._buffer('neg_hidden_probs', num_particles, self.num_hidden)
+        self._visible_probs(neg_hidden_start, neg_visible_probs)
+        self._hidden_probs(neg_visible_probs, neg_hidden_probs)
+        # Note, again, that we're using the activation *probabilities* when computing associations, not the states
+        # themselves.
+        np.dot(neg_visible_probs.T, neg_hidden_probs, out = neg_associations)
+        np.sum(neg_visible_probs, axis = 0, out = neg_visible_sums)
+        np.sum(neg_hidden_probs, axis = 0, out = neg_hidden_sums)
+
+        if persistent:
+          # Advance the fantasy particles for the next batch.
+          self._sample(neg_hidden_probs, fantasy_hidden_states, 'hidden_noise')
+        t2 = default_timer()
+
+        # Update weights, with momentum and L2 weight decay on the non-bias weights.
+        # The gradient is accumulated in place into `pos_associations`.
+        pos_associations *= 1.0 / num_batch
+        neg_associations *= 1.0 / num_particles
+        pos_associations -= neg_associations
+        if weight_decay:
+          np.multiply(self.connection_weights, weight_decay, out = neg_associations)
+          pos_associations -= neg_associations
+        self._step(self.connection_weights, velocity, pos_associations, momentum)
+
+        pos_visible_sums *= 1.0 / num_batch
+        neg_visible_sums *= 1.0 / num_particles
+        pos_visible_sums -= neg_visible_sums
+        self._step(self.visible_bias, visible_bias_velocity, pos_visible_sums, momentum)
+
+        pos_hidden_sums *= 1.0 / num_batch
+        neg_hidden_sums *= 1.0 / num_particles
+        pos_hidden_sums -= neg_hidden_sums
+        self._step(self.hidden_bias, hidden_bias_velocity, pos_hidden_sums, momentum)
+        t3 = default_timer()
+
+        self.timings['positive'] += t1 - t0
+        self.timings['negative'] += t2 - t1
+        self.timings['update'] += t3 - t2
+
+      if self._run_callbacks(callbacks, epoch, sample):
+        break
+
+  def reconstruction_error(self, data):
+    """
+    Sample the hidden units from the visible units in `data`, and return the squared error between
+    `data` and the probabilities of the visible units given these hidden states.
+    """
+    data = self._as_input(data)
+    recon = self._visible_probs(self.run_visible(data), self._buffer('recon_visible_probs', data.shape[0], self.num_visible))
+    if sparse.issparse(data):
+      # Expand the square, so that `data` is never densified.
+      recon = recon.ravel()
+      return np.dot(recon, recon) - 2 * data.multiply(recon.reshape(data.shape)).sum() + data.multiply(data).sum()
+    diff = np.subtract(data, recon, out = recon).ravel()
+    return np.dot(diff, diff)
+
+  def _run_callbacks(self, callbacks, epoch, sample):
+    """Invoke the end of epoch callbacks, returning True if any of them asks to stop training."""
+    stop = False
+    for callback in callbacks:
+      if callback(self, epoch, sample):
+        stop = True
+    return stop
+
+  def _sample_rows(self, data, sample_size):
+    """
+    Draw up to `sample_size` training examples at random from an array, or take the first ones of a
+    stream of chunks.
+    """
+    if sample_size == 0:
+      return None
+    if not callable(data):
+      num_examples = data.shape[0]
+      if num_examples <= sample_size:
+        return self._as_input(data)
+      # Sorted indices keep the reads sequential for memory-mapped data.
+      rows = np.sort(self.rng.choice(num_examples, sample_size, replace = False))
+      return self._as_input(data[rows])
+    chunks, num_rows = [], 0
+    for chunk in data():
+      chunk = self._as_input(chunk)
+      chunks.append(chunk[:sample_size - num_rows])
+      num_rows += chunks[-1].shape[0]
+      if num_rows >= sample_size:
+        break
+    if sparse.issparse(chunks[0]):
+      return sparse.vstack(chunks, format = 'csr')
+    return np.vstack(chunks)
+
+  def train_parallel(self, data, n_jobs = None, max_epochs = 1000, batch_size = 100, callbacks = None, **kwargs):
+    """
+    Train the machine on `n_jobs` worker processes at once.
+
+    The weights are moved to shared memory and each worker runs mini-batch training on its own shard
+    of the rows, updating the shared weights in place without locking (Hogwild! style). The workers
+    are synchronized at the end of every epoch. As each worker calls `train` for one epoch at a time,
+    momentum and the PCD fantasy particles restart at every epoch.
+
+    Each worker should use a single BLAS thread (e.g. OMP_NUM_THREADS=1), otherwise the workers
+    compete for the same cores.
+
+    Parameters
+    ----------
+    data: A matrix, a `np.memmap`, a `scipy.sparse` matrix or the filename of an array saved with
+      joblib. Memory-mapped files are reopened by each worker; other arrays are copied once to shared
+      memory.
+    n_jobs: Number of worker processes. Defaults to the number of cores.
+    max_epochs: Number of passes over the whole data matrix.
+    batch_size: Number of training examples per weight update within a worker.
+    callbacks: End of epoch callbacks, run in this process as in `train`.
+    kwargs: The other training options of `train` (momentum, weight_decay, persistent, shuffle).
+    """
+    import mmap
+    import multiprocessing
+
+    if n_jobs is None:
+      n_jobs = multiprocessing.cpu_count()
+
+    data = self._training_source(data, 1)
+    if callable(data):
+      raise ValueError("Parallel training needs an array or a memory-mapped file, not a stream of chunks.")
+    if callbacks is None:
+      callbacks = [Monitor()]
+    sample = self._sample_rows(data, max([getattr(c, 'sample_size', 0) for c in callbacks] + [0]))
+    self.timings = dict(positive = 0.0, negative = 0.0, update = 0.0)
+    if isinstance(data, np.memmap) and isinstance(data.base, mmap.mmap) and data.flags.c_contiguous:
+      data_spec = ('memmap', data.filename, data.dtype.str, data.shape, data.offset)
+    elif sparse.issparse(data):
+      data = self._as_input(data)
+      arrays = []
+      for array in (data.data, data.indices, data.indptr):
+        raw, shared_array = _shared_array(array.shape, array.dtype)
+        shared_array[...] = array
+        arrays.append((raw, array.dtype.str, array.shape))
+      data_spec = ('csr', arrays, data.shape)
+    else:
+      raw, shared_data = _shared_array(data.shape, self.dtype)
+      shared_data[...] = data
+      data_spec = ('shared', raw, self.dtype.str, data.shape)
+
+    # Move the parameters to shared memory, so that the updates of the workers are visible to each
+    # other and to this process.
+    params = []
+    for name in _PARAMETERS:
+      raw, shared_param = _shared_array(getattr(self, name).shape, self.dtype)
+      shared_param[...] = getattr(self, name)
+      setattr(self, name, shared_param)
+      params.append((name, raw, shared_param.shape))
+
+    seed = int(self.rng.integers(2 ** 31))
+    config = (self.num_visible, self.num_hidden, self.learning_rate, self.dtype.str, seed)
+    pool = multiprocessing.Pool(n_jobs, initializer = _init_parallel_worker,
+                                initargs = (config, params, data_spec))
+    kwargs['batch_size'] = batch_size
+    try:
+      for epoch in range(max_epochs):
+        tasks = [(shard, n_jobs, kwargs) for shard in range(n_jobs)]
+        # Sum the time spent by the workers in each phase.
+        for timings in pool.map(_train_parallel_shard, tasks, chunksize = 1):
+          for phase, seconds in timings.items():
+            self.timings[phase] += seconds
+        if self._run_callbacks(callbacks, epoch, sample):
+          break
+    finally:
+      pool.terminate()
+      pool.join()
+      # Move the parameters back to private memory.
+      for name, _, _ in params:
+        setattr(self, name, np.array(getattr(self, name)))
+
+  def _training_source(self, data, max_epochs):
+    """
+    Normalize the `data` argument of `train` to either an array or a callable returning an iterable
+    of chunks for each epoch. The array keeps its type, as it is converted batch by batch.
     """
+    if isinstance(data, str):
+      data = _load_array(data)
+    if sparse.issparse(data):
+      return data.tocsr()
+    if callable(data):
+      return data
+    if not hasattr(data, 'shape') and iter(data) is data:
+      if max_epochs > 1:
+        raise ValueError("An iterator can only be consumed for a single epoch; pass a callable "
+                         "returning a new iterable of chunks at each epoch instead.")
+      # Hand out two copies of the iterator, so that the chunks read ahead by `_sample_rows` are
+      # still seen by the training loop.
+      iterators = list(itertools.tee(data))
+      return lambda: iterators.pop(0)
+    # Matrices, including memory-mapped ones which `np.atleast_2d` leaves as they are, and lists of rows.
+    return np.atleast_2d(data)
+
+  def _batches(self, data, batch_size, shuffle):
+    """
+    Yield the training data one batch at a time, as views of a reusable work array. The batches are
+    converted to `dtype` one at a time, so that data of another type is never copied as a whole.
+    """
+    if callable(data):
+      for chunk in data():
+        chunk = chunk.tocsr() if sparse.issparse(chunk) else np.atleast_2d(chunk)
+        for batch in self._batches(chunk, batch_size, shuffle):
+          yield batch
+      return
 
     num_examples = data.shape[0]
+    if batch_size is None:
+      batch_size = num_examples
+    starts = np.arange(0, num_examples, batch_size)
 
-    # Insert bias units of 1 into the first column.
-    data = np.insert(data, 0, 1, axis = 1)
-
-    for epoch in range(max_epochs):      
-      # Clamp to the data and sample from the hidden units. 
-      # (This is the "positive CD phase", aka the reality phase.)
-      pos_hidden_activations = np.dot(data, self.weights)      
-      pos_hidden_probs = self._logistic(pos_hidden_activations)
-      pos_hidden_states = pos_hidden_probs > np.random.rand(num_examples, self.num_hidden + 1)
-      # Note that we're using the activation *probabilities* of the hidden states, not the hidden states       
-      # themselves, when computing associations. We could also use the states; see section 3 of Hinton's 
-      # "A Practical Guide to Training Restricted Boltzmann Machines" for more.
-      pos_associations = np.dot(data.T, pos_hidden_probs)
-
-      # Reconstruct the visible units and sample again from the hidden units.
-      # (This is the "negative CD phase", aka the daydreaming phase.)
-      neg_visible_activations = np.dot(pos_hidden_states, self.weights.T)
-      neg_visible_probs = self._logistic(neg_visible_activations)
-      neg_visible_probs[:,0] = 1 # Fix the bias unit.
-      neg_hidden_activations = np.dot(neg_visible_probs, self.weights)
-      neg_hidden_probs = self._logistic(neg_hidden_activations)
-      # Note, again, that we're using the activation *probabilities* when computing associations, not the states 
-      # themselves.
-      neg_associations = np.dot(neg_visible_probs.T, neg_hidden_probs)
-
-      # Update weights.
-      self.weights += self.learning_rate * ((pos_associations - neg_associations) / num_examples)
-
-      error = np.sum((data - neg_visible_probs) ** 2)
-      print("Epoch %s: error is %s" % (epoch, error))
+    if isinstance(data, np.memmap):
+      # Read contiguous blocks so that the data is streamed from disk rather than randomly accessed.
+      if shuffle:
+        self.rng.shuffle(starts)
+      for start in starts:
+        rows = data[start:start + batch_size]
+        batch = self._buffer('batch', rows.shape[0], self.num_visible)
+        batch[...] = rows
+        yield batch
+      return
+
+    order = np.arange(num_examples)
+    if shuffle:
+      self.rng.shuffle(order)
+
+    if sparse.issparse(data):
+      # Sparse batches are kept sparse, so that the positive phase uses sparse-dense products.
+      for start in starts:
+        yield data[order[start:start + batch_size]].astype(self.dtype, copy = False)
+      return
+
+    for start in starts:
+      rows = order[start:start + batch_size]
+      batch = self._buffer('batch', rows.shape[0], self.num_visible)
+      if data.dtype == self.dtype:
+        np.take(data, rows, axis = 0, out = batch, mode = 'clip') # 'clip' avoids an extra buffer.
+      else:
+        batch[...] = data[rows] # np.take does not cast into `out`.
+      yield batch
 
   def run_visible(self, data):
     """
     Assuming the RBM has been trained (so that weights for the network have been learned),
     run the network on a set of visible units, to get a sample of the hidden units.
-    
+
     Parameters
     ----------
     data: A matrix where each row consists of the states of the visible units.
-    
+
     Returns
     -------
     hidden_states: A matrix where each row consists of the hidden units activated from the visible
     units in the data matrix passed in.
     """
-    
+
+    data = self._as_input(data)
     num_examples = data.shape[0]
-    
-    # Create a matrix, where each row is to be the hidden units (plus a bias unit)
-    # sampled from a training example.
-    hidden_states = np.ones((num_examples, self.num_hidden + 1))
-    
-    # Insert bias units of 1 into the first column of data.
-    data = np.insert(data, 0, 1, axis = 1)
-
-    # Calculate the activations of the hidden units.
-    hidden_activations = np.dot(data, self.weights)
+
+    # Create a matrix, where each row is to be the hidden units sampled from a training example.
+    hidden_states = np.empty((num_examples, self.num_hidden), dtype = self.dtype)
+
     # Calculate the probabilities of turning the hidden units on.
-    hidden_probs = self._logistic(hidden_activations)
+    hidden_probs = self._hidden_probs(data, hidden_states)
     # Turn the hidden units on with their specified probabilities.
-    hidden_states[:,:] = hidden_probs > np.random.rand(num_examples, self.num_hidden + 1)
-    # Always fix the bias unit to 1.
-    # hidden_states[:,0] = 1
-  
-    # Ignore the bias units.
-    hidden_states = hidden_states[:,1:]
-    return hidden_states
-    
-  # TODO: Remove the code duplication between this method and `run_visible`?
+    return self._sample(hidden_probs, hidden_states, 'hidden_noise')
+
   def run_hidden(self, data):
     """
     Assuming the RBM has been trained (so that weights for the network have been learned),
@@ -110,34 +464,32 @@ class RBM:
     units in the data matrix passed in.
     """
 
+    data = self._as_input(data)
     num_examples = data.shape[0]
 
-    # Create a matrix, where each row is to be the visible units (plus a bias unit)
-    # sampled from a training example.
-    visible_states = np.ones((num_examples, self.num_visible + 1))
+    # Create a matrix, where each row is to be the visible units sampled from a training example.
+    visible_states = np.empty((num_examples, self.num_visible), dtype = self.dtype)
 
-    # Insert bias units of 1 into the first column of data.
-    data = np.insert(data, 0, 1, axis = 1)
-
-    # Calculate the activations of the visible units.
-    visible_activations = np.dot(data, self.weights.T)
     # Calculate the probabilities of turning the visible units on.
-    visible_probs = self._logistic(visible_activations)
+    visible_probs = self._visible_probs(data, visible_states)
     # Turn the visible units on with their specified probabilities.
-    visible_states[:,:] = visible_probs > np.random.rand(num_examples, self.num_visible + 1)
-    # Always fix the bias unit to 1.
-    # visible_states[:,0] = 1
-
-    # Ignore the bias units.
-    visible_states = visible_states[:,1:]
-    return visible_states
-    
+    return self._sample(visible_probs, visible_states, 'visible_noise')
+
+  def hidden_probabilities(self, data):
+    """
+    Return the probabilities of turning the hidden units on given the visible units in `data`, a
+    deterministic alternative to `run_visible` for feature extraction.
+    """
+    data = self._as_input(data)
+    return self._hidden_probs(data, np.empty((data.shape[0], self.num_hidden), dtype = self.dtype))
+
   def daydream(self, num_samples):
     """
     Randomly initialize the visible units once, and start running alternating Gibbs sampling steps
     (where each step consists of updating all the hidden units, and then updating all of the visible units),
     taking a sample of the visible units at each step.
-    Note that we only initialize the network *once*, so these samples are correlated.
+    Note that we only initialize the network *once*, so these samples are correlated. Use `sample_chains`
+    to draw from many independent chains at once.
 
     Returns
     -------
@@ -145,47 +497,288 @@ class RBM:
     daydreaming.
     """
 
-    # Create a matrix, where each row is to be a sample of of the visible units 
-    # (with an extra bias unit), initialized to all ones.
-    samples = np.ones((num_samples, self.num_visible + 1))
+    # Create a matrix, where each row is to be a sample of of the visible units.
+    samples = np.empty((num_samples, self.num_visible), dtype = self.dtype)
 
     # Take the first sample from a uniform distribution.
-    samples[0,1:] = np.random.rand(self.num_visible)
-
-    # Start the alternating Gibbs sampling.
-    # Note that we keep the hidden units binary states, but leave the
-    # visible units as real probabilities. See section 3 of Hinton's
-    # "A Practical Guide to Training Restricted Boltzmann Machines"
-    # for more on why.
-    for i in range(1, num_samples):
-      visible = samples[i-1,:]
-
-      # Calculate the activations of the hidden units.
-      hidden_activations = np.dot(visible, self.weights)      
-      # Calculate the probabilities of turning the hidden units on.
-      hidden_probs = self._logistic(hidden_activations)
-      # Turn the hidden units on with their specified probabilities.
-      hidden_states = hidden_probs > np.random.rand(self.num_hidden + 1)
-      # Always fix the bias unit to 1.
-      hidden_states[0] = 1
-
-      # Recalculate the probabilities that the visible units are on.
-      visible_activations = np.dot(hidden_states, self.weights.T)
-      visible_probs = self._logistic(visible_activations)
-      visible_states = visible_probs > np.random.rand(self.num_visible + 1)
-      samples[i,:] = visible_states
-
-    # Ignore the bias units (the first column), since they're always set to 1.
-    return samples[:,1:]        
-      
-  def _logistic(self, x):
-    return 1.0 / (1 + np.exp(-x))
+    samples[0,:] = self.rng.random(self.num_visible, dtype = self.dtype)
+
+    for i, visible_states in enumerate(self.sample_chains(1, num_samples - 1, initial = samples[:1])):
+      samples[i + 1,:] = visible_states[0]
+
+    return samples
+
+  def sample_chains(self, num_chains, num_samples = None, burn_in = 0, thin = 1, initial = None):
+    """
+    Run `num_chains` independent Gibbs sampling chains side by side, so that each step is a single
+    matrix-matrix product over all the chains, and lazily yield their visible states.
+
+    Parameters
+    ----------
+    num_chains: Number of independent chains.
+    num_samples: Number of samples to yield per chain, or None to sample forever.
+    burn_in: Number of Gibbs steps discarded before the first sample.
+    thin: Number of Gibbs steps between two consecutive samples.
+    initial: A (num_chains x num_visible) matrix of initial visible states. Defaults to uniform noise.
+
+    Returns
+    -------
+    A generator of (num_chains x num_visible) matrices, each row being the visible states of one chain.
+    """
+
+    if initial is None:
+      visible = self.rng.random((num_chains, self.num_visible), dtype = self.dtype)
+    else:
+      visible = np.array(initial, dtype = self.dtype)
+    hidden = np.empty((num_chains, self.num_hidden), dtype = self.dtype)
+
+    # The work arrays `visible` and `hidden` are updated in place at every step; only the
+    # yielded samples are copied.
+    step = 0
+    num_yielded = 0
+    while num_samples is None or num_yielded < num_samples:
+      # Sample the hidden units of all the chains, then their visible units.
+      self._sample(self._hidden_probs(visible, hidden), hidden, 'hidden_noise')
+      self._sample(self._visible_probs(hidden, visible), visible, 'visible_noise')
+      step += 1
+      if step > burn_in and (step - burn_in) % thin == 0:
+        num_yielded += 1
+        yield visible.copy()
+
+  def _hidden_probs(self, visible, out):
+    """Compute the probabilities of turning the hidden units on given the visible units, into `out`."""
+    self._dot(visible, self.connection_weights, out)
+    out += self.hidden_bias
+    return self._logistic(out, out = out)
+
+  def _visible_probs(self, hidden, out):
+    """Compute the probabilities of turning the visible units on given the hidden units, into `out`."""
+    self._dot(hidden, self.connection_weights.T, out)
+    out += self.visible_bias
+    return self._logistic(out, out = out)
+
+  def _as_input(self, data):
+    """
+    Convert `data` to a matrix of the floating point type of the machine, copying only if needed.
+    `scipy.sparse` matrices are converted to CSR and stay sparse.
+    """
+    if sparse.issparse(data):
+      return data.tocsr().astype(self.dtype, copy = False)
+    return np.atleast_2d(np.asarray(data, dtype = self.dtype))
+
+  def _dot(self, a, b, out):
+    """np.dot(a, b, out = out), where `a` may also be a `scipy.sparse` matrix."""
+    if sparse.issparse(a):
+      out[...] = a.dot(b)
+      return out
+    return np.dot(a, b, out = out)
+
+  def _column_sums(self, a, out):
+    """np.sum(a, axis = 0, out = out), where `a` may also be a `scipy.sparse` matrix."""
+    if sparse.issparse(a):
+      out[...] = np.asarray(a.sum(axis = 0)).ravel()
+      return out
+    return np.sum(a, axis = 0, out = out)
+
+  def _sample(self, probs, out, noise_buffer):
+    """
+    Turn units on with the given probabilities, storing the 0/1 states into `out`. The random draws
+    are written into the work array named `noise_buffer`.
+    """
+    noise = self.rng.random(dtype = self.dtype, out = self._buffer(noise_buffer, out.shape[0], out.shape[1]))
+    return np.less(noise, probs, out = out)
+
+  def _step(self, param, velocity, gradient, momentum):
+    """Apply a gradient ascent step with momentum to `param` in place. Overwrites `gradient`."""
+    gradient *= self.learning_rate
+    velocity *= momentum
+    velocity += gradient
+    param += velocity
+
+  def _buffer(self, name, num_rows, num_cols):
+    """
+    Return a (num_rows x num_cols) work array, reused across epochs and calls. A new array is only
+    allocated when the cached one is too small.
+    """
+    buffer = self._buffers.get(name)
+    if buffer is None or buffer.shape[0] < num_rows or buffer.shape[1] != num_cols:
+      buffer = np.empty((num_rows, num_cols), dtype = self.dtype)
+      self._buffers[name] = buffer
+    return buffer[:num_rows]
+
+  def _logistic(self, x, out = None):
+    # expit is numerically stable for large activations and, given `out`, works in place.
+    return expit(x, out = out)
+
+class Monitor(object):
+  """
+  Cheap monitoring and early stopping for `RBM.train`.
+
+  Every `every` epochs, compute the reconstruction error on a sample of at most `sample_size` training
+  examples and record it in `history`, as (epoch, error) pairs. If `patience` is given, ask to stop
+  the training once the error has not improved by more than `tol` for `patience` evaluations in a row.
+  """
+
+  def __init__(self, every = 10, sample_size = 1000, patience = None, tol = 0.0, verbose = True):
+    self.every = every
+    self.sample_size = sample_size
+    self.patience = patience
+    self.tol = tol
+    self.verbose = verbose
+    self.history = []
+    self.best_error = np.inf
+    self.num_bad_evaluations = 0
+
+  def __call__(self, rbm, epoch, sample):
+    if (epoch + 1) % self.every != 0:
+      return False
+
+    error = rbm.reconstruction_error(sample)
+    self.history.append((epoch, error))
+    if self.verbose:
+      print("Epoch %s: error is %s" % (epoch, error))
+
+    if error < self.best_error - self.tol:
+      self.best_error = error
+      self.num_bad_evaluations = 0
+    else:
+      self.num_bad_evaluations += 1
+    return self.patience is not None and self.num_bad_evaluations >= self.patience
+
+def _shared_array(shape, dtype):
+  """Allocate an array in memory shared with the child processes. Returns the raw buffer and the array."""
+  import multiprocessing
+  dtype = np.dtype(dtype)
+  raw = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+  return raw, np.frombuffer(raw, dtype = dtype).reshape(shape)
+
+# The machine and the training data of a `train_parallel` worker process.
+_worker_rbm = None
+_worker_data = None
+
+def _init_parallel_worker(config, params, data_spec):
+  global _worker_rbm, _worker_data
+  import os
+  num_visible, num_hidden, learning_rate, dtype, seed = config
+  _worker_rbm = RBM(num_visible, num_hidden, learning_rate, random_state = [seed, os.getpid()], dtype = dtype)
+  for name, raw, shape in params:
+    setattr(_worker_rbm, name, np.frombuffer(raw, dtype = dtype).reshape(shape))
+
+  if data_spec[0] == 'memmap':
+    _, filename, data_dtype, shape, offset = data_spec
+    _worker_data = np.memmap(filename, dtype = data_dtype, mode = 'r', shape = shape, offset = offset)
+  elif data_spec[0] == 'csr':
+    _, arrays, shape = data_spec
+    data, indices, indptr = [np.frombuffer(raw, dtype = array_dtype).reshape(array_shape)
+                             for raw, array_dtype, array_shape in arrays]
+    _worker_data = sparse.csr_matrix((data, indices, indptr), shape = shape, copy = False)
+  else:
+    _, raw, data_dtype, shape = data_spec
+    _worker_data = np.frombuffer(raw, dtype = data_dtype).reshape(shape)
+
+def _train_parallel_shard(task):
+  """Run one epoch of training on a contiguous shard of the rows, in a worker process."""
+  shard, num_shards, kwargs = task
+  num_examples = _worker_data.shape[0]
+  start = num_examples * shard // num_shards
+  stop = num_examples * (shard + 1) // num_shards
+  if start < stop:
+    _worker_rbm.train(_worker_data[start:stop], max_epochs = 1, callbacks = [], **kwargs)
+  else:
+    _worker_rbm.timings = dict(positive = 0.0, negative = 0.0, update = 0.0)
+  return _worker_rbm.timings
+
+def transform_file(model_path, input_filename, output_filename, chunk_size = 10000, n_jobs = 1,
+                   sample_states = False):
+  """
+  Transform a large file of visible units into hidden features with the RBM saved in `model_path`,
+  one chunk of rows at a time.
+
+  Each of the `n_jobs` worker processes memory-maps the weights, the input and the output, so that
+  the weights are shared at startup with zero copy and only the chunks being processed are in memory.
+
+  Parameters
+  ----------
+  input_filename: A .npy file, or an array saved with joblib, of visible units.
+  output_filename: The .npy file written, of dimensions (number of rows x num_hidden).
+  sample_states: Whether to output sampled hidden states, as `run_visible`, rather than the
+    probabilities of the hidden units, as `hidden_probabilities`.
+  """
+  import multiprocessing
+
+  rbm = RBM.load(model_path, mmap_mode = 'r')
+  num_rows = _load_array(input_filename).shape[0]
+  output = np.lib.format.open_memmap(output_filename, mode = 'w+', dtype = rbm.dtype,
+                                     shape = (num_rows, rbm.num_hidden))
+  del output
+
+  starts = range(0, num_rows, chunk_size)
+  config = (model_path, input_filename, output_filename, chunk_size, sample_states)
+  if n_jobs == 1:
+    _init_transform_worker(*config)
+    for start in starts:
+      _transform_chunk(start)
+  else:
+    pool = multiprocessing.Pool(n_jobs, initializer = _init_transform_worker, initargs = config)
+    try:
+      pool.map(_transform_chunk, starts, chunksize = 1)
+    finally:
+      pool.close()
+      pool.join()
+
+# The model, the memory-mapped input and output and the options of a `transform_file` worker.
+_transform_state = None
+
+def _init_transform_worker(model_path, input_filename, output_filename, chunk_size, sample_states):
+  global _transform_state
+  _transform_state = (RBM.load(model_path, mmap_mode = 'r'), _load_array(input_filename),
+                      np.load(output_filename, mmap_mode = 'r+'), chunk_size, sample_states)
+
+def _transform_chunk(start):
+  rbm, inputs, output, chunk_size, sample_states = _transform_state
+  chunk = inputs[start:start + chunk_size]
+  if sample_states:
+    output[start:start + chunk_size] = rbm.run_visible(chunk)
+  else:
+    output[start:start + chunk_size] = rbm.hidden_probabilities(chunk)
+  output.flush()
+
+def _load_array(filename):
+  """
+  Memory-map the array in a .npy file or in a file saved with joblib. If the file holds a tuple,
+  such as the CV splits written by `persist_cv_splits`, its first array is returned. For the index based
+  splits of `persist_cv_splits`, the training rows are gathered from the dataset file they refer to.
+  """
+  if filename.endswith('.npy'):
+    return np.load(filename, mmap_mode = 'r')
+  try:
+    import joblib
+  except ImportError:
+    from sklearn.externals import joblib
+  data = joblib.load(filename, mmap_mode = 'r')
+  if isinstance(data, (tuple, list)) and isinstance(data[0], str):
+    # (dataset filename relative to the split file, train indices, test indices)
+    data_filename, train, _ = data
+    X = joblib.load(os.path.join(os.path.dirname(filename), data_filename), mmap_mode = 'r')[0]
+    return _unpack_sparse(X)[train]
+  if isinstance(data, (tuple, list)):
+    data = data[0]
+  return _unpack_sparse(data)
+
+def _unpack_sparse(data):
+  """
+  Rebuild a sparse matrix stored by `persist_cv_splits` as a (format, data, indices, indptr, shape) tuple,
+  around its memory-mapped arrays.
+  """
+  if not isinstance(data, tuple):
+    return data
+  format, values, indices, indptr, shape = data
+  return getattr(sparse, format)((values, indices, indptr), shape = shape, copy = False)
 
 if __name__ == '__main__':
   r = RBM(num_visible = 6, num_hidden = 2)
   training_data = np.array([[1,1,1,0,0,0],[1,0,1,0,0,0],[1,1,1,0,0,0],[0,0,1,1,1,0], [0,0,1,1,0,0],[0,0,1,1,1,0]])
-  r.train(training_data, max_epochs = 5000)
+  r.train(training_data, max_epochs = 5000, callbacks = [Monitor(every = 500)])
   print(r.weights)
   user = np.array([[0,0,0,1,1,0]])
   print(r.run_visible(user))
-
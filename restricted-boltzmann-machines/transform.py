@@ -0,0 +1,17 @@
+"""
+Transform a large file of visible units into hidden features with a saved RBM, in chunks.
+
+Usage: python transform.py model_path input.npy output.npy [n_jobs] [chunk_size]
+"""
+from __future__ import print_function
+import sys
+
+from rbm import transform_file
+
+if __name__ == '__main__':
+  if len(sys.argv) < 4:
+    print(__doc__)
+    sys.exit(1)
+  n_jobs = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+  chunk_size = int(sys.argv[5]) if len(sys.argv) > 5 else 10000
+  transform_file(sys.argv[1], sys.argv[2], sys.argv[3], chunk_size = chunk_size, n_jobs = n_jobs)